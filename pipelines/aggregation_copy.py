@@ -1,37 +1,123 @@
-import shutil
+from concurrent.futures import ThreadPoolExecutor
 from glob import glob
+import shutil
+import fcntl
+import os
 
 import utils
 
+# linux ioctl that shares the extents of one file with another on btrfs, xfs and other cow filesystems
+FICLONE = 0x40049409
+
+def hardlink(src, dst):
+    os.link(src, dst)
+
+def reflink(src, dst):
+    with open(src, 'rb') as f_src, open(dst, 'wb') as f_dst:
+        try:
+            fcntl.ioctl(f_dst.fileno(), FICLONE, f_src.fileno())
+            return
+        except OSError:
+            pass
+        # copy_file_range stays in the kernel and is turned into a reflink or server side copy where supported
+        remaining = os.fstat(f_src.fileno()).st_size
+        while remaining > 0:
+            copied = os.copy_file_range(f_src.fileno(), f_dst.fileno(), remaining)
+            if copied == 0:
+                raise OSError(f'copy_file_range stopped early for {src}')
+            remaining -= copied
+    shutil.copystat(src, dst)
+
+def symlink(src, dst):
+    os.symlink(os.path.abspath(src), dst)
+
+def copy(src, dst):
+    shutil.copy2(src, dst)
+
+strategies = {
+    'hardlink': hardlink,
+    'reflink': reflink,
+    'symlink': symlink,
+    'copy': copy,
+}
+
+def stage_file(src, dst, strategy):
+    '''
+    stages src at dst with the given strategy and falls back to a plain copy when the strategy is not
+    supported, e.g. hardlinks across devices or reflinks on ext4. returns the strategy that was used.
+    '''
+    if strategy != 'copy':
+        try:
+            strategies[strategy](src, dst)
+            return strategy
+        except OSError:
+            if os.path.lexists(dst):
+                os.remove(dst)
+    copy(src, dst)
+    return 'copy'
+
+def get_item_sources(filepath):
+    item_sources = set({})
+    for source_items in utils.get_grouped_source_items(filepath):
+        for source_item in source_items:
+            item_sources.add((source_item['source'], source_item['filename']))
+    return item_sources
+
 def main(filepaths):
+    '''
+    stages the sources of all items in filepaths and removes staged sources that are no longer needed.
+    returns counts of needed and already staged files as well as staged and actually copied bytes.
+    '''
     aggregation_id = utils.get_aggregation_ids()[-1]
     tmp_source_folder = f'aggregation-store/{aggregation_id}/tmp-sources'
-    utils.create_folder(tmp_source_folder)
 
     source_filename_collection = set({})
     sources = set({})
     for filepath in filepaths:
-        for source_items in utils.get_grouped_source_items(filepath):
-            for source_item in source_items:
-                source_filename_collection.add((source_item['source'], source_item['filename']))
-                sources.add(source_item['source'])
+        source_filename_collection |= get_item_sources(filepath)
+    for source, _ in source_filename_collection:
+        sources.add(source)
+
+    stats = {
+        'files_needed': len(source_filename_collection),
+        'files_reused': len(source_filename_collection),
+        'bytes_staged': 0,
+        'bytes_copied': 0,
+    }
+    if utils.staging_strategy == 'reference':
+        # the vrts read source-store directly, see utils.get_staged_source_folder
+        if os.path.isdir(tmp_source_folder):
+            shutil.rmtree(tmp_source_folder)
+        return stats
+    utils.create_folder(tmp_source_folder)
 
     for source in sources:
         utils.create_folder(f'{tmp_source_folder}/{source}')
-    
+
     removed_files = 0
     for existing_filepath in glob(f'{tmp_source_folder}/*/*'):
         _, __, ___, source, filename = existing_filepath.split('/')
         if (source, filename) not in source_filename_collection:
-            utils.run_command(f'rm {existing_filepath}')
+            os.remove(existing_filepath)
             removed_files += 1
         else:
             source_filename_collection.remove((source, filename))
     print(f'removed {removed_files} files...')
+    stats['files_reused'] -= len(source_filename_collection)
+
+    print(f'staging {len(source_filename_collection)} files with strategy {utils.staging_strategy}...')
+    def stage(source_filename):
+        source, filename = source_filename
+        return stage_file(f'source-store/{source}/{filename}', f'{tmp_source_folder}/{source}/{filename}', utils.staging_strategy)
 
-    j = 0
-    for source, filename in source_filename_collection:
-        if j % 100 == 0:
-            print(f'copy {j + 1} / {len(source_filename_collection)}')
-        j += 1
-        shutil.copy2(f'source-store/{source}/{filename}', f'{tmp_source_folder}/{source}/{filename}')
+    used_strategies = {}
+    source_filenames = sorted(source_filename_collection)
+    with ThreadPoolExecutor(utils.staging_copy_threads) as executor:
+        for (source, filename), used_strategy in zip(source_filenames, executor.map(stage, source_filenames)):
+            used_strategies[used_strategy] = used_strategies.get(used_strategy, 0) + 1
+            size = os.path.getsize(f'source-store/{source}/{filename}')
+            stats['bytes_staged'] += size
+            if used_strategy == 'copy':
+                stats['bytes_copied'] += size
+    print(f'staged files per strategy: {used_strategies}')
+    return stats
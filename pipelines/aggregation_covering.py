@@ -1,10 +1,32 @@
 from glob import glob
+import hashlib
+import shutil
+import json
+import math
+import os
 
+import numpy as np
 import mercantile
 from ulid import ULID
 
 import utils
 
+# persisted in every aggregation folder so that the next covering only recomputes the macrotiles touched by changed sources.
+# the names must not match the *-aggregation.csv and *-downsampling.csv globs of the later steps.
+covering_lines_filename = 'covering-lines.npz'
+covering_state_filename = 'covering-state.json'
+
+line_columns = {
+    'sources': str,
+    'filenames': str,
+    'crss': str,
+    'maxzooms': np.int8,
+    'x_min': np.int64,
+    'x_max': np.int64,
+    'y_min': np.int64,
+    'y_max': np.int64,
+}
+
 def get_mercator_resolutions(minzoom, maxzoom):
     resolutions = []
     for z in range(minzoom, maxzoom + 1):
@@ -13,112 +35,235 @@ def get_mercator_resolutions(minzoom, maxzoom):
         resolutions.append((bounds.right - bounds.left) / 512)
     return resolutions
 
-def bounds_intersect(a, b):
-    left_a, bottom_a, right_a, top_a = a
-    left_b, bottom_b, right_b, top_b = b
-    dont_intersect = False
-    dont_intersect |= right_a <= left_b
-    dont_intersect |= right_b <= left_a
-    dont_intersect |= top_a <= bottom_b
-    dont_intersect |= top_b <= bottom_a
-    return not dont_intersect
-
-def get_intersecting_tiles_dfs(bounds, tile, zoom):
-    tile_bounds = mercantile.xy_bounds(tile)
-    if not bounds_intersect(bounds, tile_bounds):
-        return []
-    if tile.z == zoom:
-        return [tile]
-    result = []
-    for child in mercantile.children(tile, zoom=tile.z + 1):
-        result += get_intersecting_tiles_dfs(bounds, child, zoom)
-    return result
+def get_tile_ranges(left, bottom, right, top, zoom):
+    '''
+    inclusive x and y ranges of the tiles at zoom that intersect the given 3857 bounds arrays, touching edges do not intersect.
+    the tile edges are evaluated with the float operations of mercantile.xy_bounds, the floor estimate is corrected by one tile in either direction.
+    '''
+    n = 2 ** zoom
+    tile_size = mercantile.CE / math.pow(2, zoom)
 
-def get_macrotile_map():
-    macrotile_map = {}
-    filepaths = sorted(glob(f'source-store/*/bounds.csv'))
-    mercator_resolutions = get_mercator_resolutions(0, 32)
-    for filepath in filepaths:
-        print(f'reading {filepath}...')
-        source = filepath.split('/')[1]
-        with open(filepath) as f:
-            f.readline() # skip header
-            line = f.readline().strip()
-            while line != '':
-                filename, left, bottom, right, top, width, height, crs = line.split(',')
-                width, height = [int(a) for a in [width, height]]
-                left, bottom, right, top = [float(a) for a in [left, bottom, right, top]]
-
-                multiplier = 2
-                buffer = multiplier * utils.macrotile_buffer_3857
-                buffered_bounds = (
-                    left - buffer,
-                    bottom - buffer,
-                    right + buffer,
-                    top + buffer
-                )
-
-                tiles = get_intersecting_tiles_dfs(buffered_bounds, mercantile.Tile(x=0, y=0, z=0), utils.macrotile_z)
-                
-                maxzoom = get_smallest_overzoom(left, bottom, right, top, width, height, mercator_resolutions)
-
-                # Use at least a maxzoom of 12 (macrotile_z).
-                # Note that glo30 does not everywhere give a maxzoom of 12. Examples:
-                # S79 native maxzoom 9
-                # N66 native maxzoom 10
-                # N50 native maxzoom 11
-                # N49 native maxzoom 12 (group has only ~30 percent of total macrotiles)
-                # Use gdal warp with cubicspline when maxzoom is 12
-                maxzoom = max(maxzoom, utils.macrotile_z)
-
-                for tile in tiles:
-                    if (tile.x, tile.y) not in macrotile_map:
-                        macrotile_map[(tile.x, tile.y)] = {'sources': {}}
-                    if source not in macrotile_map[(tile.x, tile.y)]['sources']:
-                        macrotile_map[(tile.x, tile.y)]['sources'][source] = []
-                    macrotile_map[(tile.x, tile.y)]['sources'][source].append({
-                        'filename': filename,
-                        'crs': crs,
-                        'maxzoom': maxzoom,
-                    })
-                line = f.readline().strip()
-
-    return macrotile_map
-
-def get_smallest_overzoom(left, bottom, right, top, width, height, mercator_resolutions):
+    def tile_left(x):
+        return x * tile_size - mercantile.CE / 2
+
+    def tile_top(y):
+        return mercantile.CE / 2 - y * tile_size
+
+    # smallest x with tile right > left
+    x_min = np.floor((left + mercantile.CE / 2) / tile_size) - 1
+    for _ in range(3):
+        x_min += tile_left(x_min) + tile_size <= left
+    # largest x with tile left < right
+    x_max = np.floor((right + mercantile.CE / 2) / tile_size) + 1
+    for _ in range(3):
+        x_max -= tile_left(x_max) >= right
+    # smallest y with tile bottom < top
+    y_min = np.floor((mercantile.CE / 2 - top) / tile_size) - 1
+    for _ in range(3):
+        y_min += tile_top(y_min) - tile_size >= top
+    # largest y with tile top > bottom
+    y_max = np.floor((mercantile.CE / 2 - bottom) / tile_size) + 1
+    for _ in range(3):
+        y_max -= tile_top(y_max) <= bottom
+
+    x_min, y_min = [np.clip(a, 0, n).astype(np.int64) for a in [x_min, y_min]]
+    x_max, y_max = [np.clip(a, -1, n - 1).astype(np.int64) for a in [x_max, y_max]]
+    return x_min, x_max, y_min, y_max
+
+def get_macrotile_ranges(left, bottom, right, top, zoom):
+    '''
+    inclusive x and y ranges of the tiles at zoom intersecting the bounds whose ancestors all intersect the bounds too.
+    the ancestor edges can differ from the edges at zoom by rounding when the bounds touch a tile edge.
+    intersecting the ranges of all levels keeps the result identical to the former recursive covering from z0.
+    '''
+    x_min, x_max, y_min, y_max = get_tile_ranges(left, bottom, right, top, 0)
+    for z in range(1, zoom + 1):
+        x_min_z, x_max_z, y_min_z, y_max_z = get_tile_ranges(left, bottom, right, top, z)
+        x_min = np.maximum(2 * x_min, x_min_z)
+        x_max = np.minimum(2 * x_max + 1, x_max_z)
+        y_min = np.maximum(2 * y_min, y_min_z)
+        y_max = np.minimum(2 * y_max + 1, y_max_z)
+    return x_min, x_max, y_min, y_max
+
+def read_bounds(filepath):
+    '''
+    reads a bounds.csv with one array read. returns the filename and crs columns as string arrays
+    and left, bottom, right, top, width, height as float64 arrays.
+    '''
+    rows = np.loadtxt(filepath, delimiter=',', skiprows=1, dtype=str, ndmin=2, comments=None)
+    if rows.shape[0] == 0:
+        rows = np.empty((0, 8), dtype=str)
+    filenames = rows[:, 0]
+    crss = rows[:, 7]
+    left, bottom, right, top, width, height = [rows[:, j].astype(np.float64) for j in range(1, 7)]
+    return filenames, crss, left, bottom, right, top, width, height
+
+def spread_bits(a):
+    a = a.astype(np.uint64) & np.uint64(0xffffffff)
+    for shift, mask in [(16, 0x0000ffff0000ffff), (8, 0x00ff00ff00ff00ff), (4, 0x0f0f0f0f0f0f0f0f), (2, 0x3333333333333333), (1, 0x5555555555555555)]:
+        a = (a | (a << np.uint64(shift))) & np.uint64(mask)
+    return a
+
+def compact_bits(a):
+    a = a & np.uint64(0x5555555555555555)
+    for shift, mask in [(1, 0x3333333333333333), (2, 0x0f0f0f0f0f0f0f0f), (4, 0x00ff00ff00ff00ff), (8, 0x0000ffff0000ffff), (16, 0x00000000ffffffff)]:
+        a = (a | (a >> np.uint64(shift))) & np.uint64(mask)
+    return a
+
+def get_morton_keys(x, y):
+    '''
+    interleaves the bits of x and y. the macrotiles below any tile then occupy one contiguous range of keys, see get_key_range.
+    '''
+    return spread_bits(np.asarray(x)) | (spread_bits(np.asarray(y)) << np.uint64(1))
+
+def get_morton_xy(keys):
+    return compact_bits(keys).astype(np.int64), compact_bits(keys >> np.uint64(1)).astype(np.int64)
+
+def get_key_range(tile):
+    '''
+    half open range of morton keys of the macrotiles below tile.
+    '''
+    d = utils.macrotile_z - tile.z
+    start = int(get_morton_keys(tile.x << d, tile.y << d))
+    return start, start + 4 ** d
+
+def read_source_lines(filepath, mercator_resolutions):
+    '''
+    the items of one source as columns: source, filename, crs, maxzoom and the inclusive range of covered macrotiles per bounds.csv line.
+    '''
+    source = filepath.split('/')[1]
+    filenames, crss, left, bottom, right, top, width, height = read_bounds(filepath)
+
+    multiplier = 2
+    buffer = multiplier * utils.macrotile_buffer_3857
+    x_min, x_max, y_min, y_max = get_macrotile_ranges(left - buffer, bottom - buffer, right + buffer, top + buffer, utils.macrotile_z)
+
+    maxzooms = get_smallest_overzooms(left, bottom, right, top, width, height, mercator_resolutions)
+
+    # Use at least a maxzoom of 12 (macrotile_z).
+    # Note that glo30 does not everywhere give a maxzoom of 12. Examples:
+    # S79 native maxzoom 9
+    # N66 native maxzoom 10
+    # N50 native maxzoom 11
+    # N49 native maxzoom 12 (group has only ~30 percent of total macrotiles)
+    # Use gdal warp with cubicspline when maxzoom is 12
+    maxzooms = np.maximum(maxzooms, utils.macrotile_z)
+
+    return {
+        'sources': np.full(len(filenames), source),
+        'filenames': filenames,
+        'crss': crss,
+        'maxzooms': maxzooms.astype(np.int8),
+        'x_min': x_min,
+        'x_max': x_max,
+        'y_min': y_min,
+        'y_max': y_max,
+    }
+
+def concatenate_lines(lines_list):
+    lines = {}
+    for name in line_columns:
+        lines[name] = np.concatenate([source_lines[name] for source_lines in lines_list]) if len(lines_list) > 0 else np.empty(0, dtype=line_columns[name])
+    return lines
+
+def select_lines(lines, mask):
+    return {name: values[mask] for name, values in lines.items()}
+
+def get_line_macrotile_keys(lines):
+    '''
+    expands the x and y ranges of every line into one entry per covered macrotile, returns line ids and morton keys of the entries.
+    '''
+    num_x = np.maximum(lines['x_max'] - lines['x_min'] + 1, 0)
+    num_y = np.maximum(lines['y_max'] - lines['y_min'] + 1, 0)
+    counts = num_x * num_y
+    entry_line_ids = np.repeat(np.arange(len(counts)), counts)
+    k = np.arange(len(entry_line_ids)) - np.repeat(np.cumsum(counts) - counts, counts)
+    entry_x = lines['x_min'][entry_line_ids] + k // num_y[entry_line_ids]
+    entry_y = lines['y_min'][entry_line_ids] + k % num_y[entry_line_ids]
+    return entry_line_ids, get_morton_keys(entry_x, entry_y)
+
+def get_macrotile_map(lines):
+    '''
+    columnar macrotile map. every bounds.csv line is an item with interned source and crs ids, its filename and maxzoom.
+    macrotiles are stored as sorted morton keys with csr offsets into line_ids, the items covering each macrotile in file order.
+    '''
+    # ids follow the sort order of the names so that comparing ids compares names
+    sources, line_source_ids = np.unique(lines['sources'], return_inverse=True)
+    crss, line_crs_ids = np.unique(lines['crss'], return_inverse=True)
+
+    entry_line_ids, entry_keys = get_line_macrotile_keys(lines)
+    order = np.argsort(entry_keys, kind='stable')
+    keys, starts = np.unique(entry_keys[order], return_index=True)
+
+    return {
+        'sources': sources,
+        'crss': crss,
+        'line_source_ids': line_source_ids.astype(np.int32),
+        'line_filenames': lines['filenames'],
+        'line_crs_ids': line_crs_ids.astype(np.int32),
+        'line_maxzooms': lines['maxzooms'],
+        'keys': keys,
+        'offsets': np.append(starts, len(order)).astype(np.int64),
+        'line_ids': entry_line_ids[order],
+    }
+
+def get_smallest_overzooms(left, bottom, right, top, width, height, mercator_resolutions):
+    '''
+    smallest zoom whose resolution is finer than the source resolution in both directions, per bounds.
+    '''
     horizontal_resolution = (right - left) / width
     vertical_resolution = (top - bottom) / height
-    
-    for z in range(len(mercator_resolutions)):
-        if mercator_resolutions[z] < horizontal_resolution and mercator_resolutions[z] < vertical_resolution:
-            return z
-    return len(mercator_resolutions[-1])
+    resolutions = np.array(mercator_resolutions)[:, np.newaxis]
+    finer = (resolutions < horizontal_resolution) & (resolutions < vertical_resolution)
+    return np.where(finer.any(axis=0), np.argmax(finer, axis=0), len(mercator_resolutions) - 1)
 
 def add_group_ids(macrotile_map):
-    for tile_tuple in macrotile_map:
-        group_id_parts = set({})
-        for source in macrotile_map[tile_tuple]['sources']:
-            for source_item in macrotile_map[tile_tuple]['sources'][source]:
-                group_id_parts.add((source, source_item['maxzoom'], source_item['crs']))
-        group_id = tuple(sorted(list(group_id_parts)))
-        macrotile_map[tile_tuple]['group_id'] = group_id
+    '''
+    a group is the sorted set of (source, maxzoom, crs) parts of the items covering a macrotile.
+    adds the group id of every macrotile and the maxzoom of every group. macrotiles with a single part,
+    by far the most common case, are handled vectorized, only the others build their part tuples in python.
+    '''
+    line_ids = macrotile_map['line_ids']
+    num_crss = max(1, len(macrotile_map['crss']))
+    # part codes sort like the (source, maxzoom, crs) tuples since the ids follow the name order
+    line_parts = (macrotile_map['line_source_ids'].astype(np.int64) * 64 + macrotile_map['line_maxzooms']) * num_crss + macrotile_map['line_crs_ids']
+    num_parts = int(line_parts.max()) + 1 if len(line_parts) > 0 else 1
+
+    num_keys = len(macrotile_map['keys'])
+    entry_macrotiles = np.repeat(np.arange(num_keys), np.diff(macrotile_map['offsets']))
+    pairs = np.unique(entry_macrotiles * num_parts + line_parts[line_ids])
+    pair_macrotiles = pairs // num_parts
+    pair_parts = pairs % num_parts
+    parts_per_macrotile = np.bincount(pair_macrotiles, minlength=num_keys)
+    pair_offsets = np.append(0, np.cumsum(parts_per_macrotile))
+
+    group_ids = np.empty(num_keys, dtype=np.int64)
+    single = parts_per_macrotile == 1
+    single_parts, group_ids[single] = np.unique(pair_parts[pair_offsets[:-1][single]], return_inverse=True)
+    group_maxzooms = list((single_parts // num_crss) % 64)
+
+    multi_groups = {}
+    for i in np.flatnonzero(~single):
+        group = tuple(pair_parts[pair_offsets[i]:pair_offsets[i + 1]])
+        if group not in multi_groups:
+            multi_groups[group] = len(group_maxzooms)
+            group_maxzooms.append(max((part // num_crss) % 64 for part in group))
+        group_ids[i] = multi_groups[group]
+
+    macrotile_map['group_ids'] = group_ids
+    macrotile_map['group_maxzooms'] = np.array(group_maxzooms, dtype=np.int64)
 
 def get_aggregation_tiles_dfs(candidate, macrotile_map):
     if candidate.z == utils.macrotile_z:
         return [candidate]
-    macrotiles = list(mercantile.children(candidate, zoom=utils.macrotile_z))
-    group_ids = set({})
-    for macrotile in macrotiles:
-        tile_tuple = (macrotile.x, macrotile.y)
-        if tile_tuple in macrotile_map:
-            group_ids.add(macrotile_map[tile_tuple]['group_id'])
-    if len(group_ids) == 0:
+    start, end = get_key_range(candidate)
+    lo, hi = np.searchsorted(macrotile_map['keys'], np.array([start, end], dtype=np.uint64))
+    if lo == hi:
         return []
-    if len(group_ids) == 1:
-        group_id = list(group_ids)[0]
-        maxzoom = 0
-        for part in group_id:
-            maxzoom = max(maxzoom, part[1])
+    group_ids = macrotile_map['group_ids'][lo:hi]
+    group_id = group_ids[0]
+    if (group_ids == group_id).all():
+        maxzoom = macrotile_map['group_maxzooms'][group_id]
         if candidate.z >= maxzoom - utils.num_overviews:
             return [candidate]
     result = []
@@ -126,58 +271,182 @@ def get_aggregation_tiles_dfs(candidate, macrotile_map):
         result += get_aggregation_tiles_dfs(child, macrotile_map)
     return result
 
-def get_aggregation_tiles(macrotile_map):
-    candidates = set({})
-    for tile_tuple in macrotile_map.keys():
-        candidates.add(mercantile.parent(mercantile.Tile(x=tile_tuple[0], y=tile_tuple[1], z=utils.macrotile_z), zoom=utils.macrotile_z - utils.num_overviews))
+def get_aggregation_tiles(macrotile_map, candidate_keys=None):
+    '''
+    candidate_keys are the morton keys of the candidates at macrotile_z - num_overviews, all candidates with macrotiles by default.
+    '''
+    if candidate_keys is None:
+        candidate_keys = np.unique(macrotile_map['keys'] >> np.uint64(2 * utils.num_overviews))
+    candidate_xs, candidate_ys = get_morton_xy(candidate_keys)
     aggregation_tiles = []
-    for candidate in candidates:
+    for x, y in zip(candidate_xs.tolist(), candidate_ys.tolist()):
+        candidate = mercantile.Tile(x=x, y=y, z=utils.macrotile_z - utils.num_overviews)
         aggregation_tiles += get_aggregation_tiles_dfs(candidate, macrotile_map)
     return aggregation_tiles
 
 def write_aggregation_items(macrotile_map, aggregation_tiles, aggregation_id):
+    '''
+    returns the content hash of every written item by filename.
+    '''
+    item_hashes = {}
     folder = f'aggregation-store/{aggregation_id}'
     utils.create_folder(folder)
     for aggregation_tile in aggregation_tiles:
-        macrotiles = list(mercantile.children(aggregation_tile, zoom=utils.macrotile_z))
+        start, end = get_key_range(aggregation_tile)
+        lo, hi = np.searchsorted(macrotile_map['keys'], np.array([start, end], dtype=np.uint64))
+        line_ids = np.unique(macrotile_map['line_ids'][macrotile_map['offsets'][lo]:macrotile_map['offsets'][hi]])
         lines = ['source,filename,crs,maxzoom\n']
         line_tuples = set({})
         child_z = 0
-        for macrotile in macrotiles:
-            tile_tuple = (macrotile.x, macrotile.y)
-            if tile_tuple not in macrotile_map:
-                continue
-            for source in macrotile_map[tile_tuple]['sources']:
-                for source_item in macrotile_map[tile_tuple]['sources'][source]:
-                    line_tuples.add((
-                        source, 
-                        source_item['filename'], 
-                        source_item['crs'], 
-                        str(source_item['maxzoom']
-                    )))
-                    child_z = max(child_z, source_item['maxzoom'])
+        for line_id in line_ids:
+            maxzoom = int(macrotile_map['line_maxzooms'][line_id])
+            line_tuples.add((
+                str(macrotile_map['sources'][macrotile_map['line_source_ids'][line_id]]),
+                str(macrotile_map['line_filenames'][line_id]),
+                str(macrotile_map['crss'][macrotile_map['line_crs_ids'][line_id]]),
+                str(maxzoom),
+            ))
+            child_z = max(child_z, maxzoom)
         line_tuples = sorted(list(line_tuples))
         for line_tuple in line_tuples:
             lines.append(f'{",".join(line_tuple)}\n')
-        with open(f'{folder}/{aggregation_tile.z}-{aggregation_tile.x}-{aggregation_tile.y}-{child_z}-aggregation.csv', 'w') as f:
+        filename = f'{aggregation_tile.z}-{aggregation_tile.x}-{aggregation_tile.y}-{child_z}-aggregation.csv'
+        with open(f'{folder}/{filename}', 'w') as f:
             f.writelines(lines)
+        item_hashes[filename] = utils.get_aggregation_item_hash(''.join(lines))
+    return item_hashes
+
+def get_source_hash(filepath):
+    with open(filepath, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+def get_covering_parameters():
+    return {
+        'macrotile_z': utils.macrotile_z,
+        'macrotile_buffer_3857': utils.macrotile_buffer_3857,
+        'num_overviews': utils.num_overviews,
+    }
+
+def save_covering_state(aggregation_id, source_hashes, lines):
+    folder = f'aggregation-store/{aggregation_id}'
+    np.savez(f'{folder}/{covering_lines_filename}', **lines)
+    with open(f'{folder}/{covering_state_filename}', 'w') as f:
+        json.dump({'parameters': get_covering_parameters(), 'source_hashes': source_hashes}, f, indent=2)
+
+def load_covering_state(aggregation_id):
+    '''
+    returns the source hashes and lines of a previous covering, or None, None when it has no usable state.
+    the state is written last, so a covering that did not finish is never reused.
+    '''
+    folder = f'aggregation-store/{aggregation_id}'
+    if not os.path.isfile(f'{folder}/{covering_state_filename}') or not os.path.isfile(f'{folder}/{covering_lines_filename}'):
+        return None, None
+    with open(f'{folder}/{covering_state_filename}') as f:
+        state = json.load(f)
+    if state['parameters'] != get_covering_parameters():
+        return None, None
+    with np.load(f'{folder}/{covering_lines_filename}') as data:
+        lines = {name: data[name] for name in line_columns}
+    return state['source_hashes'], lines
+
+def carry_forward_items(previous_aggregation_id, aggregation_id, affected_candidate_keys):
+    '''
+    hardlinks the aggregation items of the previous covering that lie below unaffected candidates.
+    their content only depends on the macrotiles below their candidate, so they are unchanged.
+    returns the content hash of every carried item by filename.
+    '''
+    previous_item_hashes = utils.read_aggregation_manifest(previous_aggregation_id)
+    previous_item_hashes = {} if previous_item_hashes is None else previous_item_hashes['items']
+    item_hashes = {}
+    for filepath in glob(f'aggregation-store/{previous_aggregation_id}/*-aggregation.csv'):
+        filename = filepath.split('/')[-1]
+        z, x, y = [int(a) for a in filename.split('-')[:3]]
+        d = z - (utils.macrotile_z - utils.num_overviews)
+        candidate_key = get_morton_keys(x >> d, y >> d)
+        index = np.searchsorted(affected_candidate_keys, candidate_key)
+        if index < len(affected_candidate_keys) and affected_candidate_keys[index] == candidate_key:
+            continue
+        out_filepath = f'aggregation-store/{aggregation_id}/{filename}'
+        try:
+            os.link(filepath, out_filepath)
+        except OSError:
+            shutil.copy2(filepath, out_filepath)
+        if filename in previous_item_hashes:
+            item_hashes[filename] = previous_item_hashes[filename]
+        else:
+            item_hashes[filename] = utils.get_aggregation_item_hash(utils.get_aggregation_item_string(aggregation_id, filename))
+    return item_hashes
 
 def main():
+    aggregation_ids = utils.get_aggregation_ids()
+    previous_aggregation_id = aggregation_ids[-1] if len(aggregation_ids) > 0 else None
+    previous_source_hashes, previous_lines = None, None
+    if previous_aggregation_id is not None:
+        previous_source_hashes, previous_lines = load_covering_state(previous_aggregation_id)
+
+    filepaths = sorted(glob(f'source-store/*/bounds.csv'))
+    source_hashes = {filepath.split('/')[1]: get_source_hash(filepath) for filepath in filepaths}
+    changed_sources = None
+    if previous_source_hashes is not None:
+        all_sources = set(source_hashes) | set(previous_source_hashes)
+        changed_sources = sorted([source for source in all_sources if source_hashes.get(source) != previous_source_hashes.get(source)])
+        print(f'changed sources since {previous_aggregation_id}: {changed_sources}')
+    else:
+        print('no previous covering state, covering all sources...')
 
     print('get_macrotile_map...')
-    macrotile_map = get_macrotile_map()
+    mercator_resolutions = get_mercator_resolutions(0, 32)
+    lines_list = []
+    for filepath in filepaths:
+        source = filepath.split('/')[1]
+        if changed_sources is not None and source not in changed_sources:
+            lines_list.append(select_lines(previous_lines, previous_lines['sources'] == source))
+            continue
+        print(f'reading {filepath}...')
+        lines_list.append(read_source_lines(filepath, mercator_resolutions))
+    lines = concatenate_lines(lines_list)
+    macrotile_map = get_macrotile_map(lines)
 
     print('add group ids...')
     add_group_ids(macrotile_map)
 
     print('get aggregation tiles...')
-    aggregation_tiles = get_aggregation_tiles(macrotile_map)
+    affected_candidate_keys = None
+    if changed_sources is not None:
+        # candidates covered by a changed source before or after the change
+        changed_lines = concatenate_lines([
+            select_lines(previous_lines, np.isin(previous_lines['sources'], changed_sources)),
+            select_lines(lines, np.isin(lines['sources'], changed_sources)),
+        ])
+        _, changed_keys = get_line_macrotile_keys(changed_lines)
+        affected_candidate_keys = np.unique(changed_keys >> np.uint64(2 * utils.num_overviews))
+    aggregation_tiles = get_aggregation_tiles(macrotile_map, affected_candidate_keys)
 
     aggregation_id = str(ULID())
     utils.create_folder(f'aggregation-store/{aggregation_id}')
 
-    print('write aggregation items...')
-    write_aggregation_items(macrotile_map, aggregation_tiles, aggregation_id)
+    item_hashes = {}
+    if changed_sources is not None:
+        item_hashes = carry_forward_items(previous_aggregation_id, aggregation_id, affected_candidate_keys)
+        print(f'carried {len(item_hashes)} unchanged items forward from {previous_aggregation_id}...')
+
+    print(f'write {len(aggregation_tiles)} aggregation items...')
+    item_hashes.update(write_aggregation_items(macrotile_map, aggregation_tiles, aggregation_id))
+
+    removed_filenames = []
+    if previous_aggregation_id is not None:
+        previous_manifest = utils.read_aggregation_manifest(previous_aggregation_id)
+        if previous_manifest is not None:
+            previous_filenames = previous_manifest['items'].keys()
+        else:
+            previous_filenames = [filepath.split('/')[-1] for filepath in glob(f'aggregation-store/{previous_aggregation_id}/*-aggregation.csv')]
+        removed_filenames = [filename for filename in previous_filenames if filename not in item_hashes]
+    print(f'{len(removed_filenames)} aggregation items removed...')
+    utils.write_aggregation_manifest(aggregation_id, item_hashes, removed_filenames)
+
+    save_covering_state(aggregation_id, source_hashes, lines)
+
+    print(f'covering peak rss {utils.get_peak_rss_mib()} MB...')
 
 if __name__ == '__main__':
     main()
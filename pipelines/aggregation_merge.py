@@ -1,5 +1,3 @@
-from glob import glob
-from multiprocessing import Pool
 import os
 import time
 import json
@@ -10,6 +8,156 @@ from scipy import ndimage
 
 import utils
 
+# largest side length in pixels of the output blocks. memory per worker grows with (block_size + 2 * halo) ** 2,
+# not with the aggregation size, see get_block_size.
+block_size = 4096
+
+# upper bound for the peak rss of a merge worker, including gdal's block cache. compare with the peak rss log line.
+# get_pool_size divides the memory left for merging by it and get_block_size keeps every merge below it.
+worker_memory = 2 * 1024 ** 3
+
+# 22 bytes per pixel for the buffers of get_buffers and 12 for the int64 and int32 temporaries of distance_transform_cdt
+bytes_per_pixel = 34
+gdal_cache_memory = 256 * 1024 ** 2
+# interpreter, numpy, scipy and gdal before any data is read
+base_memory = 256 * 1024 ** 2
+
+# 'erosion' is the original iterative binary erosion followed by a uniform filter, its cost grows with the buffer width.
+# 'distance' gets the same eroded mask from a single taxicab distance transform of the nodata mask, its cost does not
+# depend on the buffer width.
+blending_mode = 'distance'
+
+def get_view(buffer, shape):
+    '''
+    contiguous view of shape into the front of a flat buffer
+    '''
+    return buffer[:shape[0] * shape[1]].reshape(shape)
+
+def get_buffers(shape):
+    size = shape[0] * shape[1]
+    padded_size = (shape[0] + 2) * (shape[1] + 2)
+    return {
+        'merged': np.empty(size, dtype=np.float32),
+        'current': np.empty(size, dtype=np.float32),
+        'alpha_mask': np.empty(size, dtype=np.float32),
+        'scratch': np.empty(size, dtype=np.float32),
+        'binary_mask': np.empty(size, dtype=bool),
+        'padded': np.empty(padded_size, dtype=bool),
+        'distance': np.empty(padded_size, dtype=np.int32),
+    }
+
+def apply_smoothstep(alpha_mask, scratch):
+    # 3 * a ** 2 - 2 * a ** 3 = a ** 2 * (3 - 2 * a), smoothstep with zero derivative at 0 and 1
+    np.multiply(alpha_mask, -2.0, out=scratch)
+    scratch += 3.0
+    alpha_mask *= alpha_mask
+    alpha_mask *= scratch
+
+def get_alpha_mask_erosion(binary_mask, max_pixel_distance, filter_size, buffers):
+    shape = binary_mask.shape
+    reduced = get_view(buffers['padded'], shape)
+    ndimage.binary_erosion(binary_mask, iterations=max_pixel_distance, output=reduced)
+    alpha_mask = get_view(buffers['alpha_mask'], shape)
+    ndimage.uniform_filter(reduced, filter_size, output=alpha_mask, mode='nearest')
+    apply_smoothstep(alpha_mask, get_view(buffers['scratch'], shape))
+    alpha_mask *= binary_mask
+    return alpha_mask
+
+def get_alpha_mask_distance(binary_mask, max_pixel_distance, filter_size, raster_edges, buffers):
+    '''
+    same alpha mask as get_alpha_mask_erosion. eroding by max_pixel_distance keeps exactly the pixels further than
+    max_pixel_distance (taxicab) from nodata, which a single distance transform gives at any buffer width.
+    raster_edges (top, bottom, left, right) marks the sides of the window that are raster edges, they count as nodata
+    like the border of the binary erosion.
+    '''
+    shape = binary_mask.shape
+    height, width = shape
+    top, bottom, left, right = [int(edge) for edge in raster_edges]
+    padded_shape = (height + top + bottom, width + left + right)
+    padded = get_view(buffers['padded'], padded_shape)
+    padded[...] = False
+    padded[top:top + height, left:left + width] = binary_mask
+    distance = get_view(buffers['distance'], padded_shape)
+    ndimage.distance_transform_cdt(padded, metric='taxicab', distances=distance)
+
+    # padded is not needed anymore and holds the eroded mask from here on
+    reduced = get_view(buffers['padded'], shape)
+    np.greater(distance[top:top + height, left:left + width], max_pixel_distance, out=reduced)
+    alpha_mask = get_view(buffers['alpha_mask'], shape)
+    ndimage.uniform_filter(reduced, filter_size, output=alpha_mask, mode='nearest')
+    apply_smoothstep(alpha_mask, get_view(buffers['scratch'], shape))
+    alpha_mask *= binary_mask
+    return alpha_mask
+
+def get_block_size(halo):
+    '''
+    halves block_size until the buffers of a block with its halo fit into worker_memory, but not below 512 px.
+    34 bytes per pixel give ~740 MB for a 4096 px block with a 340 px halo, the halo of three z17 layers.
+    '''
+    size = block_size
+    while size > 512 and base_memory + gdal_cache_memory + bytes_per_pixel * (size + 2 * halo) ** 2 > worker_memory:
+        size //= 2
+    return size
+
+def merge_block(srcs, nodata_index, core_window, halo, max_pixel_distance, filter_size, height, width, buffers, timings):
+    '''
+    merges the layers for the pixels in core_window. reads core_window grown by halo so that the alpha masks
+    near the block edges see the same neighborhood as a merge of the full raster would.
+    everything stays in float32 and bool and is computed in place in buffers.
+    nodata_index is the index of the first layer, blocks where it has no nodata skip the scan for holes.
+    '''
+    row_start = max(0, core_window.row_off - halo)
+    col_start = max(0, core_window.col_off - halo)
+    row_end = min(height, core_window.row_off + core_window.height + halo)
+    col_end = min(width, core_window.col_off + core_window.width + halo)
+    window = rasterio.windows.Window(col_off=col_start, row_off=row_start, width=col_end - col_start, height=row_end - row_start)
+    shape = (row_end - row_start, col_end - col_start)
+
+    t1 = time.time()
+    merged = get_view(buffers['merged'], shape)
+    srcs[0].read(1, window=window, out=merged)
+    timings['read'] += time.time() - t1
+
+    if nodata_index is not None and not utils.get_nodata_index_window(nodata_index, row_start, row_end, col_start, col_end).any():
+        timings['skipped_blocks'] += 1
+        row_off = core_window.row_off - row_start
+        col_off = core_window.col_off - col_start
+        return merged[row_off:row_off + core_window.height, col_off:col_off + core_window.width]
+
+    binary_mask = get_view(buffers['binary_mask'], shape)
+    for src in srcs[1:]:
+        t1 = time.time()
+        np.not_equal(merged, -9999, out=binary_mask)
+        timings['binary_mask'] += time.time() - t1
+        if binary_mask.all():
+            break
+
+        t1 = time.time()
+        current = get_view(buffers['current'], shape)
+        src.read(1, window=window, out=current)
+        timings['read'] += time.time() - t1
+
+        t1 = time.time()
+        if blending_mode == 'distance':
+            raster_edges = (row_start == 0, row_end == height, col_start == 0, col_end == width)
+            alpha_mask = get_alpha_mask_distance(binary_mask, max_pixel_distance, filter_size, raster_edges, buffers)
+        else:
+            alpha_mask = get_alpha_mask_erosion(binary_mask, max_pixel_distance, filter_size, buffers)
+        timings['alpha_mask'] += time.time() - t1
+
+        t1 = time.time()
+        # merged = current * (1 - alpha_mask) + merged * alpha_mask
+        scratch = get_view(buffers['scratch'], shape)
+        np.subtract(1.0, alpha_mask, out=scratch)
+        current *= scratch
+        merged *= alpha_mask
+        merged += current
+        timings['merging'] += time.time() - t1
+
+    row_off = core_window.row_off - row_start
+    col_off = core_window.col_off - col_start
+    return merged[row_off:row_off + core_window.height, col_off:col_off + core_window.width]
+
 def merge(filepath):
     print(f'merging {filepath}...')
     _, aggregation_id, filename = filepath.split('/')
@@ -28,75 +176,77 @@ def merge(filepath):
         print(f'{filepath} reprojection not done yet...')
         return
     
-    num_tiff_files = len(glob(f'{tmp_folder}/*.tiff'))
-    if num_tiff_files == 1:
-        print('single file...')
-        command = f'touch {done_filepath}'
-        utils.run_command(command)
-        return
-
-    tiff_filepaths = [f'{tmp_folder}/{i}-3857.tiff' for i in range(num_tiff_files)]
-
     buffer_pixels = None
+    layer_filepaths = None
     with open(metadata_filepath) as f:
         metadata = json.load(f)
         buffer_pixels = metadata['buffer_pixels']
+        layer_filepaths = metadata['layer_filepaths']
 
-    merged = None
-    with rasterio.env.Env(GDAL_CACHEMAX=256):
-        with rasterio.open(tiff_filepaths[0]) as src: 
-            merged = src.read(1)
-
-    for tiff_filepath in tiff_filepaths[1:]:
-        current = None
-        with rasterio.env.Env(GDAL_CACHEMAX=256):
-            with rasterio.open(tiff_filepath) as src: 
-                current = src.read(1)
-        
-        t1 = time.time()
-        binary_mask = (merged != -9999).astype('int32')
-        print(f'binary_mask done in {time.time() - t1} s...')
-
-        max_pixel_distance = int(0.5 * buffer_pixels)
-
-        t1 = time.time()
-        reduced = ndimage.binary_erosion(binary_mask, iterations=max_pixel_distance)
-        print(f'binary erosion done in {time.time() - t1} s...')
-
-        t1 = time.time()
-        alpha_mask = ndimage.uniform_filter(reduced.astype('float32'), int(1.25 * max_pixel_distance), mode='nearest')
-        alpha_mask = 3 * alpha_mask ** 2 - 2 * alpha_mask ** 3 # smoothstep with zero derivative at 0 and 1
-        alpha_mask = np.where((1 - binary_mask), 0.0, alpha_mask)
-        print(f'alpha_mask done in {time.time() - t1} s...')
-
-        t1 = time.time()
-        merged = current * (1 - alpha_mask) + merged * alpha_mask
-        print(f'merging done in {time.time() - t1} s...')
+    if len(layer_filepaths) == 1:
+        print('single file...')
+        command = f'touch {done_filepath}'
+        utils.run_command(command)
+        return
 
-        if -9999 not in merged:
-            break
+    max_pixel_distance = int(0.5 * buffer_pixels)
+    filter_size = int(1.25 * max_pixel_distance)
+    # a merged pixel depends on the layers within this distance. every further layer widens the dependency.
+    halo = (max_pixel_distance + filter_size // 2 + 1) * (len(layer_filepaths) - 1)
+
+    # blending can turn valid pixels near holes into -9999 where the next layer has nodata, so the indices of the
+    # other layers say nothing about holes after a merge. those are found by scanning the merged values.
+    nodata_index = utils.read_nodata_index(layer_filepaths[0])
+
+    merge_block_size = get_block_size(halo)
+    print(f'{merge_block_size} px blocks with a {halo} px halo...')
+
+    timings = {'read': 0.0, 'binary_mask': 0.0, 'alpha_mask': 0.0, 'merging': 0.0, 'writing': 0.0, 'skipped_blocks': 0}
+    with rasterio.env.Env(GDAL_CACHEMAX=gdal_cache_memory // 1024 ** 2):
+        srcs = [rasterio.open(layer_filepath) for layer_filepath in layer_filepaths]
+        height = srcs[0].height
+        width = srcs[0].width
+        buffers = get_buffers((min(height, merge_block_size + 2 * halo), min(width, merge_block_size + 2 * halo)))
+        with rasterio.open(
+            utils.get_merged_filepath(tmp_folder, layer_filepaths),
+            'w',
+            driver='GTiff',
+            height=height,
+            width=width,
+            count=1,
+            dtype='float32',
+            tiled=True,
+            blockxsize=512,
+            blockysize=512,
+        ) as dst:
+            for row in range(0, height, merge_block_size):
+                for col in range(0, width, merge_block_size):
+                    core_window = rasterio.windows.Window(
+                        col_off=col,
+                        row_off=row,
+                        width=min(merge_block_size, width - col),
+                        height=min(merge_block_size, height - row),
+                    )
+                    merged = merge_block(srcs, nodata_index, core_window, halo, max_pixel_distance, filter_size, height, width, buffers, timings)
+                    t1 = time.time()
+                    dst.write(merged, 1, window=core_window)
+                    timings['writing'] += time.time() - t1
+        for src in srcs:
+            src.close()
+
+    for step, duration in timings.items():
+        if step == 'skipped_blocks':
+            print(f'{duration} blocks without holes...')
+        else:
+            print(f'{step} done in {duration} s...')
+    # aggregation_run runs every merge in a fresh process, so this is the peak of this merge
+    print(f'merge {filename} peak rss {utils.get_peak_rss_mib()} MB...')
 
-    t1 = time.time()
-    with rasterio.open(
-        f'{tmp_folder}/{num_tiff_files}-3857.tiff',
-        'w',
-        driver='GTiff',
-        height=merged.shape[0],
-        width=merged.shape[1],
-        count=1,
-        dtype='float32',
-        tiled=True,
-        blockxsize=512,
-        blockysize=512,
-    ) as dst:
-        dst.write(merged, 1)
-    print(f'writing done in {time.time() - t1} s...')
-    
     command = f'touch {done_filepath}'
     utils.run_command(command)
     
-def main(filepaths):
-    # needs ~30 GB per thread
-    pool_size = 2
-    with Pool(pool_size) as pool:
-        pool.starmap(merge, [(filepath,) for filepath in filepaths])
+def get_pool_size(merge_memory):
+    '''
+    one worker per core as long as the workers fit into merge_memory, the memory that the other stages leave
+    '''
+    return max(1, min(os.cpu_count(), merge_memory // worker_memory))
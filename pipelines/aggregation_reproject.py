@@ -1,12 +1,14 @@
-from multiprocessing import Pool
 import json
 import os
 
-import rasterio
 import mercantile
 
 import utils
 
+# upper bound for the memory of a reproject worker: gdal_translate with a 512 MB block cache plus the working memory
+# of the warper, which -multi splits between its threads
+worker_memory = 1024 ** 3
+
 def create_virtual_raster(filepath, source_items, tmp_source_folder):
     source = source_items[0]['source']
     command = f'gdalbuildvrt -overwrite {filepath}'
@@ -19,18 +21,25 @@ def get_resolution(zoom):
     bounds = mercantile.xy_bounds(tile)
     return (bounds.right - bounds.left) / 512
 
-def create_warp(vrt_filepath, vrt_3857_filepath, crs, zoom, aggregation_tile, buffer):
+def create_warp(vrt_filepath, vrt_3857_filepath, crs, zoom, aggregation_tile, buffer, multithreaded=True):
+    '''
+    multithreaded warps with all cores whenever the vrt is read. only for a single reader like gdal_translate,
+    not for a vrt that every tiling worker reads at once.
+    '''
     left, bottom, right, top = mercantile.xy_bounds(aggregation_tile)
     left -= buffer
     bottom -= buffer
     right += buffer
     top += buffer
     resolution = get_resolution(zoom)
-    command = f'gdalwarp -of vrt -multi -wo NUM_THREADS=ALL_CPUS -overwrite '
+    command = f'gdalwarp -of vrt -overwrite '
+    if multithreaded:
+        command += f'-multi -wo NUM_THREADS=ALL_CPUS '
     command += f'-s_srs {crs} -t_srs EPSG:3857 '
     command += f'-tr {resolution} {resolution} '
     command += f'-te {left} {bottom} {right} {top} '
     command += f'-r cubicspline '
+    command += f'-co BLOCKXSIZE=512 -co BLOCKYSIZE=512 '
     command += f'{vrt_filepath} {vrt_3857_filepath}'
     utils.run_command(command)
 
@@ -43,23 +52,6 @@ def translate(in_filepath, out_filepath):
     command += f'{out_filepath}'
     utils.run_command(command)
 
-def contains_nodata_pixels(filepath):
-    with rasterio.env.Env(GDAL_CACHEMAX=64):
-        with rasterio.open(filepath) as src:
-            block_size = 1024
-            for row in range(0, src.height, block_size):
-                for col in range(0, src.width, block_size):
-                    window = rasterio.windows.Window(
-                        col_off=col,
-                        row_off=row,
-                        width=min(block_size, src.width - col),
-                        height=min(block_size, src.height - row)
-                    )
-                    data = src.read(1, window=window)
-                    if -9999 in data:
-                        return True
-    return False
-
 def reproject(filepath, aggregation_id):
     print(f'reprojecting {filepath}...')
     filename = filepath.split('/')[-1]
@@ -86,33 +78,40 @@ def reproject(filepath, aggregation_id):
         buffer_pixels = int(utils.macrotile_buffer_3857 / resolution)
         buffer_3857_rounded = buffer_pixels * resolution
 
-    tmp_source_folder = f'aggregation-store/{aggregation_id}/tmp-sources'
+    tmp_source_folder = utils.get_staged_source_folder(aggregation_id)
+    layer_filepaths = []
     for i, source_items in enumerate(grouped_source_items):
         vrt_filepath = f'{tmp_folder}/{i}.vrt'
         create_virtual_raster(vrt_filepath, source_items, tmp_source_folder)
         crs = source_items[0]['crs']
         zoom = maxzoom
         vrt_3857_filepath = f'{tmp_folder}/{i}-3857.vrt'
-        create_warp(vrt_filepath, vrt_3857_filepath, crs, zoom, aggregation_tile, buffer_3857_rounded)
+
+        # items with several layers are always materialized, the early stop needs the nodata index
+        # and merge would warp the halo of every block again
+        materialize = utils.materialize_reprojection or len(grouped_source_items) > 1
+        create_warp(vrt_filepath, vrt_3857_filepath, crs, zoom, aggregation_tile, buffer_3857_rounded, multithreaded=materialize)
+        if not materialize:
+            # tiling reads the warped vrt block by block
+            layer_filepaths.append(vrt_3857_filepath)
+            continue
+
         out_filepath = f'{tmp_folder}/{i}-3857.tiff'
         translate(vrt_3857_filepath, out_filepath)
-
-        if len(grouped_source_items) > 1 and not contains_nodata_pixels(out_filepath):
-            break
+        layer_filepaths.append(out_filepath)
+
+        if len(grouped_source_items) > 1:
+            # merge only reads the index of the first layer, see aggregation_merge.merge_block
+            if i == 0:
+                layer_has_nodata = utils.create_nodata_index(out_filepath).any()
+            else:
+                layer_has_nodata = utils.has_nodata(out_filepath)
+            if not layer_has_nodata:
+                break
     
     metadata = {
         'buffer_pixels': buffer_pixels,
+        'layer_filepaths': layer_filepaths,
     }
     with open(metadata_filepath, 'w') as f:
         json.dump(metadata, f, indent=2)
-
-def main(filepaths):
-    aggregation_ids = utils.get_aggregation_ids()
-    aggregation_id = aggregation_ids[-1]
-
-    argument_tuples = []
-    for filepath in filepaths:
-        argument_tuples.append((filepath, aggregation_id))
-    
-    with Pool() as pool:
-        pool.starmap(reproject, argument_tuples)
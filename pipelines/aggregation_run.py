@@ -1,18 +1,136 @@
 from glob import glob
+from concurrent.futures import ThreadPoolExecutor
+import multiprocessing
 import shutil
+import threading
 import time
 import datetime
 import os
 
+from pmtiles.tile import zxy_to_tileid
+
 import aggregation_copy
 import aggregation_reproject
 import aggregation_merge
 import aggregation_tile
 import utils
 
+# reproject, merge and tile run at the same time and share the memory, see get_pool_sizes. budgets per worker:
+# aggregation_reproject.worker_memory (1 GiB), aggregation_merge.worker_memory (2 GiB), aggregation_tile.worker_memory (512 MiB).
+# reproject and tile together take at most this share of the available memory, merge gets the rest.
+reproject_tile_memory_share = 0.5
+# tiling parallelizes over the blocks of a single item and uses all cores on its own.
+tile_concurrency = 1
+
+# the pools are used from the item threads and the merge pool replaces its worker after every task. forking from a
+# threaded process can copy a held lock into the child, so the workers are forked from a single-threaded server.
+# they see the module settings as written in the source, not changes made at runtime.
+pool_context = multiprocessing.get_context('forkserver')
+pool_context.set_forkserver_preload(['aggregation_reproject', 'aggregation_merge', 'aggregation_tile'])
+
+# a batch is closed once its sources would exceed the byte budget or it holds max_batch_size items
+staging_budget_bytes = 64 * 1024 ** 3
+max_batch_size = 128
+
+def get_hilbert_key(filepath):
+    '''
+    position of the item on the hilbert curve at macrotile zoom, items of different zooms interleave by their top left macrotile.
+    '''
+    z, x, y = [int(a) for a in filepath.split('/')[-1].split('-')[:3]]
+    scale = 2 ** (utils.macrotile_z - z)
+    return zxy_to_tileid(utils.macrotile_z, x * scale, y * scale)
+
+def get_batches(filepaths):
+    '''
+    orders items along the hilbert curve so that neighbors sharing source files land in the same batch.
+    a source counts against the budget of a batch once, no matter how many of its items reference it.
+    '''
+    filepaths = sorted(filepaths, key=get_hilbert_key)
+    source_sizes = {}
+    batches = []
+    batch = []
+    batch_sources = set({})
+    batch_bytes = 0
+    for filepath in filepaths:
+        new_sources = aggregation_copy.get_item_sources(filepath) - batch_sources
+        new_bytes = 0
+        for source, filename in new_sources:
+            if (source, filename) not in source_sizes:
+                source_sizes[(source, filename)] = os.path.getsize(f'source-store/{source}/{filename}')
+            new_bytes += source_sizes[(source, filename)]
+        if len(batch) > 0 and (batch_bytes + new_bytes > staging_budget_bytes or len(batch) == max_batch_size):
+            batches.append(batch)
+            batch = []
+            batch_sources = set({})
+            batch_bytes = 0
+            new_sources = aggregation_copy.get_item_sources(filepath)
+            new_bytes = sum(source_sizes[source_filename] for source_filename in new_sources)
+        batch.append(filepath)
+        batch_sources |= new_sources
+        batch_bytes += new_bytes
+    if len(batch) > 0:
+        batches.append(batch)
+    return batches
 
+def get_pool_sizes():
+    '''
+    reproject and tile pools of one worker per core as long as each takes at most half of reproject_tile_memory_share,
+    the merge pool is sized from the memory they leave. returns the reproject, merge and tile pool sizes.
+    '''
+    available_memory = utils.get_available_memory()
+    stage_memory = int(0.5 * reproject_tile_memory_share * available_memory)
+    reproject_pool_size = max(1, min(os.cpu_count(), stage_memory // aggregation_reproject.worker_memory))
+    tile_pool_size = max(1, min(os.cpu_count(), stage_memory // aggregation_tile.worker_memory))
+    reserved_memory = reproject_pool_size * aggregation_reproject.worker_memory + tile_pool_size * aggregation_tile.worker_memory
+    merge_pool_size = aggregation_merge.get_pool_size(available_memory - reserved_memory)
+    return reproject_pool_size, merge_pool_size, tile_pool_size
+
+def process_item(filepath, aggregation_id, reproject_pool, merge_pool, tile_pool, tile_semaphore, tile_timings):
+    '''
+    moves one aggregation item through reproject, merge and tile as soon as its previous stage is done.
+    the marker files written by the stages stay the source of truth, so a rerun resumes where it stopped.
+    returns the time the item spent in each stage.
+    '''
+    stage_timings = {}
+
+    t1 = time.time()
+    reproject_pool.apply(aggregation_reproject.reproject, (filepath, aggregation_id))
+    stage_timings['reproject'] = time.time() - t1
+
+    t1 = time.time()
+    merge_pool.apply(aggregation_merge.merge, (filepath,))
+    stage_timings['merge'] = time.time() - t1
+
+    with tile_semaphore:
+        t1 = time.time()
+        aggregation_tile.tile(filepath, aggregation_id, tile_pool, tile_timings)
+        stage_timings['pmtiles'] = time.time() - t1
 
-def main():    
+    tmp_folder = filepath.replace('-aggregation.csv', '-tmp')
+    shutil.rmtree(tmp_folder)
+    utils.run_command(f'touch {filepath.replace("-aggregation.csv", "-aggregation.done")}')
+    return stage_timings
+
+def run_pipeline(filepaths, aggregation_id):
+    stage_timings = {'reproject': 0.0, 'merge': 0.0, 'pmtiles': 0.0}
+    tile_timings = aggregation_tile.get_timings()
+    tile_semaphore = threading.Semaphore(tile_concurrency)
+    reproject_pool_size, merge_pool_size, tile_pool_size = get_pool_sizes()
+    print(f'{reproject_pool_size} reproject, {merge_pool_size} merge and {tile_pool_size} tile workers...')
+    # enough items in flight to keep every stage busy, the others wait in their thread
+    item_threads = reproject_pool_size + merge_pool_size + tile_concurrency
+    with pool_context.Pool(reproject_pool_size) as reproject_pool, pool_context.Pool(merge_pool_size, maxtasksperchild=1) as merge_pool:
+        with pool_context.Pool(tile_pool_size) as tile_pool:
+            with ThreadPoolExecutor(item_threads) as executor:
+                futures = []
+                for filepath in filepaths:
+                    futures.append(executor.submit(process_item, filepath, aggregation_id, reproject_pool, merge_pool, tile_pool, tile_semaphore, tile_timings))
+                for future in futures:
+                    for stage, duration in future.result().items():
+                        stage_timings[stage] += duration
+    return stage_timings, tile_timings
+
+def main():
     aggregation_ids = utils.get_aggregation_ids()
     aggregation_id = aggregation_ids[-1]
 
@@ -22,40 +140,30 @@ def main():
     else:
         last_aggregation_id = aggregation_ids[-2]
         dirty_filepaths = [f'aggregation-store/{aggregation_id}/{filename}' for filename in utils.get_dirty_aggregation_filenames(aggregation_id, last_aggregation_id)]
-    
+
     dirty_filepaths = [filepath for filepath in dirty_filepaths if not os.path.isfile(filepath.replace('-aggregation.csv', '-aggregation.done'))]
     if len(dirty_filepaths) == 0:
         print('nothing to do.')
     else:
         print(f'start aggregating {len(dirty_filepaths)} items...')
 
-    batch_size = 128
-    starts = range(0, len(dirty_filepaths), batch_size)
-
-    for start in starts:
-        print(f'batch {start}:{start + batch_size}. {datetime.datetime.now()}.')
-        filepath_batch = dirty_filepaths[start:start + batch_size]
+    batches = get_batches(dirty_filepaths)
+    for j, filepath_batch in enumerate(batches):
+        print(f'batch {j + 1} / {len(batches)} with {len(filepath_batch)} items. {datetime.datetime.now()}.')
 
+        # the staged sources are shared by the whole batch, so copying stays a barrier between batches
         t1 = time.time()
-        aggregation_copy.main(filepath_batch)
+        copy_stats = aggregation_copy.main(filepath_batch)
+        reuse_ratio = copy_stats['files_reused'] / max(1, copy_stats['files_needed'])
         print(f't_copy: {int(time.time() - t1)} s. {datetime.datetime.now()}.')
+        print(f'staged {copy_stats["bytes_staged"] / 1024 ** 3:.2f} GiB, copied {copy_stats["bytes_copied"] / 1024 ** 3:.2f} GiB, reused {copy_stats["files_reused"]} / {copy_stats["files_needed"]} sources ({reuse_ratio:.0%}).')
 
         t1 = time.time()
-        aggregation_reproject.main(filepath_batch)
-        print(f't_reproject: {int(time.time() - t1)} s. {datetime.datetime.now()}.')
-
-        t1 = time.time()
-        aggregation_merge.main(filepath_batch)
-        print(f't_merge: {int(time.time() - t1)} s. {datetime.datetime.now()}.')
-
-        t1 = time.time()
-        aggregation_tile.main(filepath_batch)
-        print(f't_pmtiles: {int(time.time() - t1)} s. {datetime.datetime.now()}.')
-
-        for filepath in filepath_batch:
-            tmp_folder = filepath.replace('-aggregation.csv', '-tmp')
-            shutil.rmtree(tmp_folder)
-            utils.run_command(f'touch {filepath.replace("-aggregation.csv", "-aggregation.done")}')
+        stage_timings, tile_timings = run_pipeline(filepath_batch, aggregation_id)
+        print(f't_reproject: {int(stage_timings["reproject"])} s summed over items.')
+        print(f't_merge: {int(stage_timings["merge"])} s summed over items.')
+        print(f't_pmtiles: {int(stage_timings["pmtiles"])} s summed over items. {aggregation_tile.get_timings_summary(tile_timings)}.')
+        print(f't_pipeline: {int(time.time() - t1)} s. {datetime.datetime.now()}.')
 
 if __name__ == '__main__':
     main()
@@ -1,90 +1,179 @@
-from glob import glob
+import itertools
 import math
-from multiprocessing import Pool
 import os
 import json
+import time
 
+import numpy as np
 import mercantile
 import rasterio
+from pmtiles.tile import zxy_to_tileid
 
 import utils
+import terrarium
+import webp
 
-def create_tiles(tmp_folder, aggregation_tile, tiff_filepath, buffer_pixels):
+# tiles per side of the square blocks read by the workers in a single window
+block_tiles = 4
+
+# gdal block cache of a worker, gdal would otherwise take 5% of the ram in every process
+gdal_cache_memory = 64 * 1024 ** 2
+# upper bound for the memory of a worker: interpreter, gdal cache and the read and encode buffers of a block
+worker_memory = 512 * 1024 ** 2
+
+# encode buffers of a pool worker, reused across blocks and items of the same block size
+worker_buffers = {}
+
+def get_worker_buffers(block_size):
+    if block_size not in worker_buffers:
+        worker_buffers.clear()
+        worker_buffers[block_size] = (
+            np.empty((block_size, block_size, 512, 512, 3), dtype=np.uint8),
+            np.empty((2, block_size, block_size, 512, 512), dtype=np.float32),
+        )
+    return worker_buffers[block_size]
+
+def create_tiles(aggregation_tile, tiff_filepath, buffer_pixels, pool, timings, counts):
+    '''
+    yields (z, x, y, tile_bytes) in tile id order so that the tiles can be streamed into the archive writer.
+    the blocks are encoded in pool, which aggregation_run shares between all items.
+    timings collects the number of blocks and the read and encode time summed over all blocks.
+    counts collects the number of tiles, of constant tiles and of omitted empty tiles, see create_block.
+    '''
     base_x = aggregation_tile.x
     base_y = aggregation_tile.y
     base_z = aggregation_tile.z
 
     child_z = None
     with rasterio.open(tiff_filepath) as src:
-        assert len(src.block_shapes) >= 1
-        assert src.block_shapes[0] == (512, 512)
+        if not tiff_filepath.endswith('.vrt'):
+            assert len(src.block_shapes) >= 1
+            assert src.block_shapes[0] == (512, 512)
         horizontal_block_count = (src.width - 2 * buffer_pixels) / 512
         assert math.floor(horizontal_block_count) == horizontal_block_count
         child_z = base_z + int(math.log2(horizontal_block_count))
+
+    # aligned square blocks are contiguous in tile id order, so sorting the blocks
+    # by their own tile id keeps the tiles sorted across blocks
+    block_size = min(block_tiles, 2 ** (child_z - base_z))
+    block_z = child_z - int(math.log2(block_size))
     argument_tuples = []
-    z = child_z
-    x_min = base_x * 2 ** (z - base_z)
-    y_min = base_y * 2 ** (z - base_z)
-    for i, x in enumerate(range(x_min, x_min + 2 ** (z - base_z))):
-        for j, y in enumerate(range(y_min, y_min + 2 ** (z - base_z))):
-            out_filepath = f'{tmp_folder}/{z}-{x}-{y}.webp'
-            argument_tuples.append((i, j, tiff_filepath, out_filepath, buffer_pixels))
-    
-    with Pool() as pool:
-        pool.starmap(create_tile, argument_tuples)
-
-def create_tile(i, j, tiff_filepath, out_filepath, buffer_pixels):
-    col_start = i * 512 + buffer_pixels
-    col_end = (i + 1) * 512 + buffer_pixels
-    row_start = j * 512 + buffer_pixels
-    row_end = (j + 1) * 512 + buffer_pixels
+    for block in mercantile.children(aggregation_tile, zoom=block_z):
+        i = (block.x - base_x * 2 ** (block_z - base_z)) * block_size
+        j = (block.y - base_y * 2 ** (block_z - base_z)) * block_size
+        argument_tuples.append((zxy_to_tileid(block.z, block.x, block.y), tiff_filepath, block, i, j, block_size, buffer_pixels))
+    argument_tuples = sorted(argument_tuples, key=lambda a: a[0])
+
+    for tiles, t_read, t_encode, num_constant, num_omitted in pool.imap(create_block, argument_tuples):
+        timings['blocks'] += 1
+        timings['read'] += t_read
+        timings['encode'] += t_encode
+        counts['tiles'] += len(tiles)
+        counts['constant'] += num_constant
+        counts['omitted'] += num_omitted
+        for tile in tiles:
+            yield tile
+
+def create_block(argument_tuple):
+    _, tiff_filepath, block, i, j, block_size, buffer_pixels = argument_tuple
+    t1 = time.time()
     window = rasterio.windows.Window(
-        col_off=col_start,
-        row_off=row_start,
-        width=col_end - col_start,
-        height=row_end - row_start
+        col_off=i * 512 + buffer_pixels,
+        row_off=j * 512 + buffer_pixels,
+        width=block_size * 512,
+        height=block_size * 512,
     )
-    subdata = None
-    with rasterio.open(tiff_filepath) as src: 
-        subdata = src.read(1, window=window, out_shape=(512, 512))
-    subdata[subdata == -9999] = 0
-    utils.save_terrarium_tile(subdata, out_filepath)
+    # a block is 16 tiles, opening the raster per block keeps no handle open after the pool is gone
+    with rasterio.env.Env(GDAL_CACHEMAX=gdal_cache_memory // 1024 ** 2):
+        with rasterio.open(tiff_filepath) as src:
+            data = src.read(1, window=window)
+    nodata = data == -9999
+    data[nodata] = 0
+    t_read = time.time() - t1
 
-def main(filepaths):
-    aggregation_ids = utils.get_aggregation_ids()
-    aggregation_id = aggregation_ids[-1]
+    t1 = time.time()
+    rgb, scratch = get_worker_buffers(block_size)
+    # (row, col, 512, 512) views of the block
+    stack = data.reshape((block_size, 512, block_size, 512)).transpose((0, 2, 1, 3))
+    empty = nodata.reshape((block_size, 512, block_size, 512)).all(axis=(1, 3))
+    # flat tiles, e.g. open sea or filled nodata, reuse the encoded tile of their elevation
+    constant = stack.min(axis=(2, 3)) == stack.max(axis=(2, 3))
+    if not constant.any():
+        terrarium.encode(stack, out=rgb, scratch=scratch)
+    else:
+        for row, col in zip(*np.nonzero(~constant)):
+            terrarium.encode(stack[row, col], out=rgb[row, col], scratch=scratch[:, row, col])
 
-    for j, filepath in enumerate(filepaths):
-        print(f'tiling {filepath}. {j + 1} / {len(filepaths)}.')
-        filename = filepath.split('/')[-1]
+    children = []
+    num_omitted = 0
+    for child in mercantile.children(block, zoom=block.z + int(math.log2(block_size))):
+        row = child.y - block.y * block_size
+        col = child.x - block.x * block_size
+        if utils.omit_empty_tiles and empty[row, col]:
+            num_omitted += 1
+            continue
+        children.append((child, row, col))
+    encoded_children = [(child, row, col) for child, row, col in children if not constant[row, col]]
+    tile_bytes_by_child = dict(zip(
+        [child for child, _, _ in encoded_children],
+        webp.encode_batch([rgb[row, col] for _, row, col in encoded_children]),
+    ))
+    tiles = []
+    for child, row, col in children:
+        if constant[row, col]:
+            tile_bytes = webp.encode_constant(stack[row, col, 0, 0])
+        else:
+            tile_bytes = tile_bytes_by_child[child]
+        tiles.append((zxy_to_tileid(child.z, child.x, child.y), child.z, child.x, child.y, tile_bytes))
+    tiles = [tile[1:] for tile in sorted(tiles, key=lambda t: t[0])]
+    t_encode = time.time() - t1
+    num_constant = len(children) - len(encoded_children)
+    return tiles, t_read, t_encode, num_constant, num_omitted
 
-        z, x, y, child_z = [int(a) for a in filename.replace('-aggregation.csv', '').split('-')]
+def get_timings():
+    return {'blocks': 0, 'read': 0.0, 'encode': 0.0}
 
-        tmp_folder = f'aggregation-store/{aggregation_id}/{z}-{x}-{y}-{child_z}-tmp'
+def get_timings_summary(timings):
+    if timings['blocks'] == 0:
+        return 'no blocks tiled'
+    return f'read {int(timings["read"])} s, encode {int(timings["encode"])} s summed over {timings["blocks"]} blocks'
 
+def tile(filepath, aggregation_id, pool, timings):
+    filename = filepath.split('/')[-1]
 
-        pmtiles_done_filepath = f'{tmp_folder}/pmtiles-done'
-        if os.path.isfile(pmtiles_done_filepath):
-            print(f'tiling {filename} already done...')
-            continue
+    z, x, y, child_z = [int(a) for a in filename.replace('-aggregation.csv', '').split('-')]
 
-        merge_done = os.path.isfile(f'{tmp_folder}/merge-done')
-        if not merge_done:
-            print('merge not done yet...')
-            continue
+    tmp_folder = f'aggregation-store/{aggregation_id}/{z}-{x}-{y}-{child_z}-tmp'
+
+    pmtiles_done_filepath = f'{tmp_folder}/pmtiles-done'
+    if os.path.isfile(pmtiles_done_filepath):
+        print(f'tiling {filename} already done...')
+        return
+
+    merge_done = os.path.isfile(f'{tmp_folder}/merge-done')
+    if not merge_done:
+        print('merge not done yet...')
+        return
+
+    buffer_pixels = None
+    tiff_filepath = None
+    with open(f'{tmp_folder}/reprojection.json') as f:
+        metadata = json.load(f)
+        buffer_pixels = metadata['buffer_pixels']
+        tiff_filepath = utils.get_merged_filepath(tmp_folder, metadata['layer_filepaths'])
 
-        buffer_pixels = None
-        with open(f'{tmp_folder}/reprojection.json') as f:
-            metadata = json.load(f)
-            buffer_pixels = metadata['buffer_pixels']
-
-        num_tiff_files = len(glob(f'{tmp_folder}/*.tiff'))
-        tiff_filepath = f'{tmp_folder}/{num_tiff_files - 1}-3857.tiff'
-
-        aggregation_tile = mercantile.Tile(x=x, y=y, z=z)
-        out_folder = utils.get_pmtiles_folder(x, y, z)
-        utils.create_folder(out_folder)
-        out_filepath = f'{out_folder}/{z}-{x}-{y}-{child_z}.pmtiles'
-        create_tiles(tmp_folder, aggregation_tile, tiff_filepath, buffer_pixels)
-        utils.create_archive(tmp_folder, out_filepath)
-        utils.run_command(f'touch {pmtiles_done_filepath}')
+    aggregation_tile = mercantile.Tile(x=x, y=y, z=z)
+    out_folder = utils.get_pmtiles_folder(x, y, z)
+    utils.create_folder(out_folder)
+    out_filepath = f'{out_folder}/{z}-{x}-{y}-{child_z}.pmtiles'
+    counts = {'tiles': 0, 'constant': 0, 'omitted': 0}
+    tiles = create_tiles(aggregation_tile, tiff_filepath, buffer_pixels, pool, timings, counts)
+    first_tile = next(tiles, None)
+    if first_tile is None:
+        # every tile was empty and omitted, pmtiles archives cannot be empty
+        if os.path.isfile(out_filepath):
+            os.remove(out_filepath)
+    else:
+        utils.write_archive(itertools.chain([first_tile], tiles), out_filepath)
+    print(f'{counts["tiles"]} tiles, {counts["constant"]} constant tiles reused an encoded tile, {counts["omitted"]} empty tiles omitted.')
+    utils.run_command(f'touch {pmtiles_done_filepath}')
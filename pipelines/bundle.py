@@ -1,122 +1,191 @@
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict
 from glob import glob
 import math
+import mmap
 import os
 import json
 import tempfile
 import gzip
-import shutil
 
+import numpy as np
 import mercantile
-from pmtiles.tile import zxy_to_tileid, tileid_to_zxy, TileType, Compression, Entry, serialize_directory, serialize_header
-from pmtiles.reader import Reader, MmapSource, all_tiles
+from pmtiles.tile import zxy_to_tileid, tileid_to_zxy, TileType, Compression, deserialize_header, serialize_header
 
 import utils
 
-#### START COPY https://github.com/protomaps/PMTiles/blob/main/python/pmtiles/pmtiles/writer.py
-
-def build_roots_leaves(entries, leaf_size):
-    root_entries = []
-    leaves_bytes = b""
-    num_leaves = 0
-
-    i = 0
-    while i < len(entries):
-        num_leaves += 1
-        serialized = serialize_directory(entries[i : i + leaf_size])
-        root_entries.append(
-            Entry(entries[i].tile_id, len(leaves_bytes), len(serialized), 0)
-        )
-        leaves_bytes += serialized
-        i += leaf_size
-
-    return serialize_directory(root_entries), leaves_bytes, num_leaves
-
-
-def optimize_directories(entries, target_root_len):
-    test_bytes = serialize_directory(entries)
-    if len(test_bytes) < target_root_len:
-        return test_bytes, b"", 0
-
-    leaf_size = 4096
+tmp_folder = '/data1/tmp'
+
+# same directory layout as pmtiles.writer: a root of less than target_root_length bytes,
+# otherwise leaves of min_leaf_size entries, doubled until the root fits
+target_root_length = 16384 - 127
+min_leaf_size = 4096
+# the root alone is only tried up to this many entries. every entry takes at least 4 varint bytes and deflate
+# compresses at most 1032:1, so a root with more entries cannot be shorter than target_root_length.
+max_root_entries = 1032 * target_root_length // 4
+directory_threads = 8
+# flat tiles like open sea are ~50 bytes and repeat in every archive, tiles of up to max_dedup_length bytes are
+# deduplicated across archives by their content. every archive is already deduplicated by pmtiles.writer and tiles
+# with any relief are orders of magnitude larger. the least recently used of at most max_dedup_contents are kept.
+max_dedup_length = 256
+max_dedup_contents = 65536
+
+# one tile entry of the bundle, 24 bytes instead of a pmtiles.tile.Entry object
+entry_dtype = np.dtype([('tile_id', '<u8'), ('offset', '<u8'), ('length', '<u4'), ('run_length', '<u4')])
+
+def encode_varints(values):
+    '''
+    concatenated varints of uint64 values, same encoding as pmtiles.tile.write_varint
+    '''
+    values = np.asarray(values, dtype=np.uint64)
+    num_bytes = np.ones(len(values), dtype=np.int64)
+    for k in range(1, 10):
+        num_bytes += values >= np.uint64(1 << (7 * k))
+    starts = np.cumsum(num_bytes) - num_bytes
+    out = np.empty(int(num_bytes.sum()), dtype=np.uint8)
+    for k in range(int(num_bytes.max()) if len(values) > 0 else 0):
+        selected = num_bytes > k
+        low_bits = ((values[selected] >> np.uint64(7 * k)) & np.uint64(0x7f)).astype(np.uint8)
+        continuation = (num_bytes[selected] > k + 1).astype(np.uint8) << 7
+        out[starts[selected] + k] = low_bits | continuation
+    return out.tobytes()
+
+def decode_varints(buf):
+    '''
+    all varints of buf as uint64, see encode_varints
+    '''
+    data = np.frombuffer(buf, dtype=np.uint8)
+    if len(data) == 0:
+        return np.zeros(0, dtype=np.uint64)
+    ends = np.flatnonzero(data < 0x80)
+    starts = np.concatenate([[0], ends[:-1] + 1])
+    positions = np.arange(ends[-1] + 1) - np.repeat(starts, ends - starts + 1)
+    parts = (data[:ends[-1] + 1] & 0x7f).astype(np.uint64) << (7 * positions).astype(np.uint64)
+    return np.bitwise_or.reduceat(parts, starts)
+
+def serialize_directory(entries):
+    '''
+    pmtiles.tile.serialize_directory for an entry_dtype array
+    '''
+    offsets = entries['offset'] + np.uint64(1)
+    if len(entries) > 1:
+        # 0 marks an entry whose data directly follows the data of the previous entry
+        contiguous = entries['offset'][1:] == entries['offset'][:-1] + entries['length'][:-1]
+        offsets[1:][contiguous] = 0
+    values = np.concatenate([
+        np.array([len(entries)], dtype=np.uint64),
+        np.diff(entries['tile_id'], prepend=np.uint64(0)),
+        entries['run_length'].astype(np.uint64),
+        entries['length'].astype(np.uint64),
+        offsets,
+    ])
+    return gzip.compress(encode_varints(values), mtime=0)
+
+def deserialize_directory(buf):
+    '''
+    pmtiles.tile.deserialize_directory into an entry_dtype array
+    '''
+    values = decode_varints(gzip.decompress(buf))
+    n = int(values[0])
+    entries = np.empty(n, dtype=entry_dtype)
+    entries['tile_id'] = np.cumsum(values[1:n + 1])
+    entries['run_length'] = values[n + 1:2 * n + 1]
+    entries['length'] = values[2 * n + 1:3 * n + 1]
+    raw_offsets = values[3 * n + 1:4 * n + 1]
+    # an offset of 0 continues after the data of the previous entry, i.e. after the last explicit offset
+    indices = np.arange(n)
+    anchors = np.maximum.accumulate(np.where((raw_offsets != 0) | (indices == 0), indices, 0))
+    cumulative_lengths = np.zeros(n + 1, dtype=np.uint64)
+    np.cumsum(entries['length'], dtype=np.uint64, out=cumulative_lengths[1:])
+    entries['offset'] = raw_offsets[anchors] - np.uint64(1) + cumulative_lengths[indices] - cumulative_lengths[anchors]
+    return entries
+
+def read_entries(mapping, header):
+    '''
+    all tile entries of an archive in tile id order with the leaf directories resolved
+    '''
+    def read_directory(offset, length):
+        entries = deserialize_directory(mapping[offset:offset + length])
+        chunks = []
+        start = 0
+        for leaf_index in np.flatnonzero(entries['run_length'] == 0):
+            chunks.append(entries[start:leaf_index])
+            leaf = entries[leaf_index]
+            chunks += read_directory(header['leaf_directory_offset'] + int(leaf['offset']), int(leaf['length']))
+            start = leaf_index + 1
+        chunks.append(entries[start:])
+        return chunks
+    return np.concatenate(read_directory(header['root_offset'], header['root_length']))
+
+def get_zoom_base(z):
+    # tile id of the first tile at zoom z
+    return ((1 << (2 * z)) - 1) // 3
+
+def get_tile_id_range(filepath):
+    '''
+    [first, end) tile ids of an archive. its tiles are the descendants of its extent at a single zoom,
+    which are a contiguous range on the hilbert curve.
+    '''
+    z, x, y, child_z = [int(a) for a in filepath.split('/')[-1].replace('.pmtiles', '').split('-')]
+    num_tiles = 4 ** (child_z - z)
+    first = get_zoom_base(child_z) + (zxy_to_tileid(z, x, y) - get_zoom_base(z)) * num_tiles
+    return first, first + num_tiles
+
+def get_merge_groups(filepaths):
+    '''
+    filepaths in tile id order, grouped so that only archives with overlapping tile id ranges share a group
+    '''
+    groups = []
+    group_end = -1
+    for filepath in sorted(filepaths, key=get_tile_id_range):
+        first, end = get_tile_id_range(filepath)
+        if first >= group_end:
+            groups.append([])
+        groups[-1].append(filepath)
+        group_end = max(group_end, end)
+    return groups
+
+def merge_entries(entries):
+    '''
+    k-way merge of the sorted entries of the archives by tile id
+    '''
+    if len(entries) == 1:
+        return entries[0]
+    entries = np.concatenate(entries)
+    # a stable sort of sorted runs is a merge
+    return entries[np.argsort(entries['tile_id'], kind='stable')]
+
+def build_roots_leaves(entries, leaf_size, leaves_file):
+    '''
+    serializes leaves of leaf_size entries in parallel into leaves_file, returns the root directory and the leaves length
+    '''
+    starts = range(0, len(entries), leaf_size)
+    leaves_file.seek(0)
+    leaves_file.truncate()
+    root_entries = np.zeros(len(starts), dtype=entry_dtype)
+    offset = 0
+    with ThreadPoolExecutor(directory_threads) as executor:
+        for j, leaf_bytes in enumerate(executor.map(lambda start: serialize_directory(entries[start:start + leaf_size]), starts)):
+            root_entries[j] = (entries[starts[j]]['tile_id'], offset, len(leaf_bytes), 0)
+            leaves_file.write(leaf_bytes)
+            offset += len(leaf_bytes)
+    return serialize_directory(root_entries), offset
+
+def optimize_directories(entries, leaves_file):
+    '''
+    returns the root directory and the length of the leaves written to leaves_file
+    '''
+    if len(entries) <= max_root_entries:
+        root_bytes = serialize_directory(entries)
+        if len(root_bytes) < target_root_length:
+            return root_bytes, 0
+    leaf_size = min_leaf_size
     while True:
-        root_bytes, leaves_bytes, num_leaves = build_roots_leaves(entries, leaf_size)
-        if len(root_bytes) < target_root_len:
-            return root_bytes, leaves_bytes, num_leaves
+        root_bytes, leaves_length = build_roots_leaves(entries, leaf_size, leaves_file)
+        if len(root_bytes) < target_root_length:
+            return root_bytes, leaves_length
         leaf_size *= 2
 
-
-class Writer:
-    def __init__(self, f, tmp_dir):
-        self.f = f
-        self.tile_entries = []
-        self.hash_to_offset = {}
-        self.tile_f = tempfile.TemporaryFile(dir=tmp_dir)
-        self.offset = 0
-        self.addressed_tiles = 0
-        self.clustered = True
-
-    def write_tile(self, tileid, data):
-        if len(self.tile_entries) > 0 and tileid < self.tile_entries[-1].tile_id:
-            self.clustered = False
-
-        hsh = hash(data)
-        if hsh in self.hash_to_offset:
-            last = self.tile_entries[-1]
-            found = self.hash_to_offset[hsh]
-            if tileid == last.tile_id + last.run_length and last.offset == found:
-                self.tile_entries[-1].run_length += 1
-            else:
-                self.tile_entries.append(Entry(tileid, found, len(data), 1))
-        else:
-            self.tile_f.write(data)
-            self.tile_entries.append(Entry(tileid, self.offset, len(data), 1))
-            self.hash_to_offset[hsh] = self.offset
-            self.offset += len(data)
-
-        self.addressed_tiles += 1
-
-    def finalize(self, header, metadata):
-        header["addressed_tiles_count"] = self.addressed_tiles
-        header["tile_entries_count"] = len(self.tile_entries)
-        header["tile_contents_count"] = len(self.hash_to_offset)
-
-        self.tile_entries = sorted(self.tile_entries, key=lambda e: e.tile_id)
-
-        header["min_zoom"] = tileid_to_zxy(self.tile_entries[0].tile_id)[0]
-        header["max_zoom"] = tileid_to_zxy(self.tile_entries[-1].tile_id)[0]
-
-        root_bytes, leaves_bytes, num_leaves = optimize_directories(
-            self.tile_entries, 16384 - 127
-        )
-
-        compressed_metadata = gzip.compress(json.dumps(metadata).encode())
-        header["clustered"] = self.clustered
-        header["internal_compression"] = Compression.GZIP
-        header["root_offset"] = 127
-        header["root_length"] = len(root_bytes)
-        header["metadata_offset"] = header["root_offset"] + header["root_length"]
-        header["metadata_length"] = len(compressed_metadata)
-        header["leaf_directory_offset"] = (
-            header["metadata_offset"] + header["metadata_length"]
-        )
-        header["leaf_directory_length"] = len(leaves_bytes)
-        header["tile_data_offset"] = (
-            header["leaf_directory_offset"] + header["leaf_directory_length"]
-        )
-        header["tile_data_length"] = self.offset
-
-        header_bytes = serialize_header(header)
-
-        self.f.write(header_bytes)
-        self.f.write(root_bytes)
-        self.f.write(compressed_metadata)
-        self.f.write(leaves_bytes)
-        self.tile_f.seek(0)
-        shutil.copyfileobj(self.tile_f, self.f)
-        self.tile_f.close()
-
-#### END COPY https://github.com/protomaps/PMTiles/blob/main/python/pmtiles/pmtiles/writer.py
-
 def get_parent_to_filepaths():
     filepaths = sorted(glob('pmtiles-store/*.pmtiles') + glob('pmtiles-store/*/*.pmtiles'))
 
@@ -143,45 +212,162 @@ def get_parent_to_filepaths():
 
     return parent_to_filepath
 
+def open_archive(filepath):
+    with open(filepath, 'rb') as f:
+        mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    return mapping, deserialize_header(mapping[0:127])
+
+def copy_range(src_fd, dst_fd, offset, length):
+    '''
+    appends length bytes of src_fd starting at offset to dst_fd without reading them into python.
+    copy_file_range stays in the kernel and can share extents, sendfile covers filesystems that refuse it.
+    '''
+    end = offset + length
+    try:
+        while offset < end:
+            copied = os.copy_file_range(src_fd, dst_fd, end - offset, offset)
+            if copied == 0:
+                raise OSError('copy_file_range stopped early')
+            offset += copied
+        return
+    except OSError:
+        pass
+    while offset < end:
+        sent = os.sendfile(dst_fd, src_fd, offset, end - offset)
+        if sent == 0:
+            raise OSError('sendfile stopped early')
+        offset += sent
+
+def copy_tile_data(mapping, header, entries, src_fd, dst_fd, dst_offset, content_offsets):
+    '''
+    appends the tile data section of an archive to dst_fd, which holds dst_offset bytes so far, and points the entries
+    of the archive to their data in dst_fd. tiles of up to max_dedup_length bytes whose content is in content_offsets
+    are left out and point to the earlier copy, everything between them is copied in bulk without reading it.
+    returns the number of bytes copied and of contents left out.
+    '''
+    data_offset = header['tile_data_offset']
+    small = entries['length'] <= max_dedup_length
+    small_offsets, first = np.unique(entries['offset'][small], return_index=True)
+    small_lengths = entries['length'][small][first]
+
+    removed_starts = []
+    removed_lengths = []
+    removed_targets = []
+    removed_length = 0
+    for offset, length in zip(small_offsets.tolist(), small_lengths.tolist()):
+        content = mapping[data_offset + offset:data_offset + offset + length]
+        if content in content_offsets:
+            content_offsets.move_to_end(content)
+            removed_starts.append(offset)
+            removed_lengths.append(length)
+            removed_targets.append(content_offsets[content])
+            removed_length += length
+        else:
+            content_offsets[content] = dst_offset + offset - removed_length
+            if len(content_offsets) > max_dedup_contents:
+                content_offsets.popitem(last=False)
+
+    start = 0
+    for offset, length in zip(removed_starts, removed_lengths):
+        copy_range(src_fd, dst_fd, data_offset + start, offset - start)
+        start = offset + length
+    copy_range(src_fd, dst_fd, data_offset + start, header['tile_data_length'] - start)
+
+    if len(removed_starts) == 0:
+        entries['offset'] += np.uint64(dst_offset)
+        return header['tile_data_length'], 0
+    removed_starts = np.array(removed_starts, dtype=np.uint64)
+    removed_before = np.zeros(len(removed_starts) + 1, dtype=np.uint64)
+    np.cumsum(np.array(removed_lengths, dtype=np.uint64), out=removed_before[1:])
+    # number of left out tiles before each entry, which is the index of the tile itself for left out entries
+    indices = np.searchsorted(removed_starts, entries['offset'])
+    removed = removed_starts[np.minimum(indices, len(removed_starts) - 1)] == entries['offset']
+    offsets = entries['offset'] + np.uint64(dst_offset) - removed_before[indices]
+    offsets[removed] = np.array(removed_targets, dtype=np.uint64)[indices[removed]]
+    entries['offset'] = offsets
+    return header['tile_data_length'] - removed_length, len(removed_targets)
+
 def create_archive(filepaths, out_filepath):
-    with open(out_filepath, 'wb') as f1:
-        writer = Writer(f1, '/data1/tmp')
+    '''
+    merges the archives into one archive. archives are visited in tile id order and the tile data section of each
+    is copied in bulk, python only handles the directory entries, whose offsets are shifted by the data copied before.
+    small tiles are deduplicated across archives, see copy_tile_data.
+    the entries go to a numpy table on disk, memory is bounded by the largest group of overlapping archives
+    and nothing is sorted at the end. the bundle is clustered when all archives are clustered and none overlap.
+    '''
+    with tempfile.TemporaryFile(dir=tmp_folder) as entries_file, tempfile.TemporaryFile(dir=tmp_folder) as tile_file:
+        num_entries = 0
+        addressed_tiles = 0
+        tile_contents = 0
+        tile_data_length = 0
+        clustered = True
         min_z = math.inf
         max_z = 0
         min_lon = math.inf
         min_lat = math.inf
         max_lon = -math.inf
         max_lat = -math.inf
-        for j, filepath in enumerate(filepaths):
-            filename = filepath.split('/')[-1]
-            print(f'{filename} {j + 1} / {len(filepaths)}')
-            z, x, y, _ = [int(a) for a in filename.replace('.pmtiles', '').split('-')]
-            
-            with open(filepath , 'r+b') as f2:
-                reader = Reader(MmapSource(f2))
-                for tile_tuple, tile_bytes in all_tiles(reader.get_bytes):
-                    tile_id = zxy_to_tileid(*tile_tuple)
-                    writer.write_tile(tile_id, tile_bytes)
-
-            max_z = max(max_z, z)
-            min_z = min(min_z, z)
-            west, south, east, north = mercantile.bounds(x, y, z)
-            min_lon = min(min_lon, west)
-            min_lat = min(min_lat, south)
-            max_lon = max(max_lon, east)
-            max_lat = max(max_lat, north)
-
-        min_lon_e7 = int(min_lon * 1e7)
-        min_lat_e7 = int(min_lat * 1e7)
-        max_lon_e7 = int(max_lon * 1e7)
-        max_lat_e7 = int(max_lat * 1e7)
-
-        writer.finalize(
-            {
+        content_offsets = OrderedDict()
+        j = 0
+        for group in get_merge_groups(filepaths):
+            readers = []
+            group_entries = []
+            for filepath in group:
+                j += 1
+                filename = filepath.split('/')[-1]
+                print(f'{filename} {j} / {len(filepaths)}')
+                z, x, y, _ = [int(a) for a in filename.replace('.pmtiles', '').split('-')]
+                mapping, header = open_archive(filepath)
+                readers.append((mapping, header))
+
+                entries = read_entries(mapping, header)
+                with open(filepath, 'rb') as f:
+                    copied_length, num_duplicates = copy_tile_data(
+                        mapping, header, entries, f.fileno(), tile_file.fileno(), tile_data_length, content_offsets
+                    )
+                group_entries.append(entries)
+                tile_data_length += copied_length
+                tile_contents += header['tile_contents_count'] - num_duplicates
+                clustered = clustered and header['clustered']
+
+                max_z = max(max_z, z)
+                min_z = min(min_z, z)
+                west, south, east, north = mercantile.bounds(x, y, z)
+                min_lon = min(min_lon, west)
+                min_lat = min(min_lat, south)
+                max_lon = max(max_lon, east)
+                max_lat = max(max_lat, north)
+
+            entries = merge_entries(group_entries)
+            if len(readers) > 1:
+                # the tiles of overlapping archives interleave while their data does not
+                clustered = False
+
+            entries.tofile(entries_file)
+            num_entries += len(entries)
+            addressed_tiles += int(entries['run_length'].sum(dtype=np.uint64))
+            for mapping, _ in readers:
+                mapping.close()
+
+        entries_file.flush()
+        entries = np.memmap(entries_file, dtype=entry_dtype, mode='r', shape=(num_entries,))
+        with tempfile.TemporaryFile(dir=tmp_folder) as leaves_file:
+            root_bytes, leaves_length = optimize_directories(entries, leaves_file)
+
+            min_lon_e7 = int(min_lon * 1e7)
+            min_lat_e7 = int(min_lat * 1e7)
+            max_lon_e7 = int(max_lon * 1e7)
+            max_lat_e7 = int(max_lat * 1e7)
+
+            compressed_metadata = gzip.compress(json.dumps({
+                'attribution': '<a href="https://github.com/mapterhorn/mapterhorn">© Mapterhorn</a>'
+            }).encode())
+
+            header = {
                 'tile_type': TileType.WEBP,
                 'tile_compression': Compression.NONE,
-                'min_zoom': min_z,
-                'max_zoom': max_z,
+                'min_zoom': tileid_to_zxy(int(entries[0]['tile_id']))[0],
+                'max_zoom': tileid_to_zxy(int(entries[-1]['tile_id']))[0],
                 'min_lon_e7': min_lon_e7,
                 'min_lat_e7': min_lat_e7,
                 'max_lon_e7': max_lon_e7,
@@ -189,11 +375,30 @@ def create_archive(filepaths, out_filepath):
                 'center_zoom': int(0.5 * (min_z + max_z)),
                 'center_lon_e7': int(0.5 * (min_lon_e7 + max_lon_e7)),
                 'center_lat_e7': int(0.5 * (min_lat_e7 + max_lat_e7)),
-            },
-            {
-                'attribution': '<a href="https://github.com/mapterhorn/mapterhorn">© Mapterhorn</a>'
-            },
-        )
+                'addressed_tiles_count': addressed_tiles,
+                'tile_entries_count': num_entries,
+                'tile_contents_count': tile_contents,
+                'clustered': clustered,
+                'internal_compression': Compression.GZIP,
+                'root_offset': 127,
+                'root_length': len(root_bytes),
+            }
+            header['metadata_offset'] = header['root_offset'] + header['root_length']
+            header['metadata_length'] = len(compressed_metadata)
+            header['leaf_directory_offset'] = header['metadata_offset'] + header['metadata_length']
+            header['leaf_directory_length'] = leaves_length
+            header['tile_data_offset'] = header['leaf_directory_offset'] + header['leaf_directory_length']
+            header['tile_data_length'] = tile_data_length
+            del entries
+
+            with open(out_filepath, 'wb') as f:
+                f.write(serialize_header(header))
+                f.write(root_bytes)
+                f.write(compressed_metadata)
+                f.flush()
+                leaves_file.flush()
+                copy_range(leaves_file.fileno(), f.fileno(), 0, leaves_length)
+                copy_range(tile_file.fileno(), f.fileno(), 0, tile_data_length)
 
 def get_md5sum(filepath):
     out, _ = utils.run_command(f'md5sum {filepath}')
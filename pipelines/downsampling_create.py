@@ -1,69 +1,287 @@
+from collections import OrderedDict
 from glob import glob
-import io
+import mmap
 from multiprocessing import Pool
 import shutil
 from datetime import datetime
 import os
 
-import numpy as np
-from PIL import Image
-import imagecodecs
 import mercantile
-from pmtiles.reader import Reader, MmapSource
+from pmtiles.tile import deserialize_header, deserialize_directory, find_tile, zxy_to_tileid
 
 import utils
+import reduction
+import webp
 
-def create_tile(parent_x, parent_y, parent_z, aggregation_id, tmp_folder, pmtiles_filenames):
-    tile_to_pmtiles_filename = get_tile_to_pmtiles_filename(pmtiles_filenames)
-    full_data = np.zeros((1024, 1024), dtype=np.float32)
+# per worker. a downsampling item reads from a handful of archives, parents are handed out in chunks of neighbors.
+reader_cache_size = 16
+directory_cache_size = 256
+
+# 'pyramid' creates up to pyramid_height parent zooms in one pass. parents whose children were created in the same pass
+# are reduced from memory instead of decoding the children again from the archive written by the previous zoom.
+# 'level' creates one zoom per item and reads all children from the archives.
+# 'pyramid' is opt-in, on a single core it was no faster than 'level' and it has not been measured on more cores yet.
+downsampling_mode = 'level'
+pyramid_height = utils.num_overviews
+# every unit of a pass creates its pyramid on one core. passes are made lower until they start from at least this
+# many units, at low zooms with few tiles a pass covers a single zoom and works like 'level'.
+min_pyramid_units = 4 * os.cpu_count()
+
+# 'box' averages the 2x2 child pixels below every parent pixel.
+# 'antialias' applies a [1, 3, 3, 1] / 8 tent filter that reaches one pixel into the neighboring children,
+# it needs the finished neighbors of every parent and therefore always runs level by level.
+downsampling_filter = 'box'
+# average only valid pixels instead of counting missing children as 0 m, see reduction.reduce_children.
+# parents without any valid pixel are left out of the archive so that the next zoom sees them as missing as well.
+# validity is known per pixel within a pyramid pass and per tile when children are read from an archive.
+# archives cannot store the mask, partial parents are written with 0 m at their invalid pixels. the antialias filter,
+# level mode and the highest zoom of every pyramid pass read those pixels as valid and still pull toward 0 m there.
+masked_downsampling = False
+# per worker, edges of decoded children that neighboring parents need for the antialias halo
+edge_cache_size = 4096
+
+worker_archive_index = None
+worker_item_index = None
+worker_max_zoom = None
+worker_readers = OrderedDict()
+worker_directories = OrderedDict()
+worker_buffers = {}
+worker_edges = OrderedDict()
+
+def init_worker(archive_index):
+    global worker_archive_index
+    worker_archive_index = archive_index
+    clear_archive_cache()
+    worker_edges.clear()
+
+def clear_archive_cache():
+    while len(worker_readers) > 0:
+        _, (mapping, _) = worker_readers.popitem()
+        mapping.close()
+    worker_directories.clear()
+
+def get_archive_index(pmtiles_filenames):
+    '''
+    {(z, x, y, zoom): filename} of the archive extents and the zoom of their tiles, see find_archive
+    '''
+    archive_index = {}
+    for pmtiles_filename in pmtiles_filenames:
+        pmtiles_z, pmtiles_x, pmtiles_y, zoom = [int(a) for a in pmtiles_filename.replace('.pmtiles', '').split('-')]
+        archive_index[(pmtiles_z, pmtiles_x, pmtiles_y, zoom)] = pmtiles_filename
+    return archive_index
+
+def get_zoom_archive_index(aggregation_id, zoom):
+    '''
+    archive index of every aggregation and downsampling archive with tiles at zoom, not only those of one item
+    '''
+    filepaths = glob(f'aggregation-store/{aggregation_id}/*-{zoom}-aggregation.csv')
+    filepaths += glob(f'aggregation-store/{aggregation_id}/*-{zoom}-downsampling.csv')
+    pmtiles_filenames = []
+    for filepath in filepaths:
+        filename = filepath.split('/')[-1]
+        pmtiles_filenames.append(filename.replace('-aggregation.csv', '.pmtiles').replace('-downsampling.csv', '.pmtiles'))
+    return get_archive_index(pmtiles_filenames)
+
+def find_archive(z, x, y, archive_index):
+    '''
+    the archive with tiles at zoom z whose extent contains the tile, found by walking up the parents of the tile.
+    works the same for the downsampling item index of get_item_index.
+    '''
+    for d in range(z + 1):
+        filename = archive_index.get((z - d, x >> d, y >> d, z))
+        if filename is not None:
+            return filename
+    return None
+
+def get_archive_reader(filename):
+    '''
+    mmapped archive and its header, least recently used archives are closed.
+    None for items that have no archive, see write_item_archive. tiles are only left out with masked_downsampling
+    or utils.omit_empty_tiles, otherwise a missing archive is an error and not a patch of sea.
+    '''
+    if filename in worker_readers:
+        worker_readers.move_to_end(filename)
+        return worker_readers[filename]
+    file_z, file_x, file_y, _ = [int(a) for a in filename.replace('.pmtiles', '').split('-')]
+    pmtiles_folder = utils.get_pmtiles_folder(file_x, file_y, file_z)
+    if not os.path.isfile(f'{pmtiles_folder}/{filename}'):
+        if masked_downsampling or utils.omit_empty_tiles:
+            return None
+        raise FileNotFoundError(f'{pmtiles_folder}/{filename} is missing')
+    with open(f'{pmtiles_folder}/{filename}', 'rb') as f:
+        mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    worker_readers[filename] = (mapping, deserialize_header(mapping[0:127]))
+    if len(worker_readers) > reader_cache_size:
+        evicted_filename, (evicted_mapping, _) = worker_readers.popitem(last=False)
+        for key in [key for key in worker_directories if key[0] == evicted_filename]:
+            del worker_directories[key]
+        evicted_mapping.close()
+    return worker_readers[filename]
+
+def get_directory(filename, mapping, offset, length):
+    key = (filename, offset)
+    if key in worker_directories:
+        worker_directories.move_to_end(key)
+        return worker_directories[key]
+    worker_directories[key] = deserialize_directory(mapping[offset:offset + length])
+    if len(worker_directories) > directory_cache_size:
+        worker_directories.popitem(last=False)
+    return worker_directories[key]
+
+def get_tile_bytes(z, x, y):
+    '''
+    same lookup as pmtiles.reader.Reader.get on the cached archives and directories, None for missing tiles
+    '''
+    filename = find_archive(z, x, y, worker_archive_index)
+    if filename is None:
+        return None
+    reader = get_archive_reader(filename)
+    if reader is None:
+        return None
+    mapping, header = reader
+    tile_id = zxy_to_tileid(z, x, y)
+    dir_offset = header['root_offset']
+    dir_length = header['root_length']
+    for depth in range(0, 4): # max depth
+        result = find_tile(get_directory(filename, mapping, dir_offset, dir_length), tile_id)
+        if result is None:
+            return None
+        if result.run_length == 0:
+            dir_offset = header['leaf_directory_offset'] + result.offset
+            dir_length = result.length
+        else:
+            return mapping[header['tile_data_offset'] + result.offset:header['tile_data_offset'] + result.offset + result.length]
+    return None
+
+def get_worker_buffers(zoom):
+    '''
+    reduction buffers of the worker, one set per zoom because the pyramid recursion holds the buffers of every level
+    '''
+    if zoom not in worker_buffers:
+        worker_buffers[zoom] = reduction.get_buffers()
+    return worker_buffers[zoom]
+
+def get_edges(z, x, y, buffers):
+    '''
+    edges of a tile from the archives for the antialias halo, None for missing tiles
+    '''
+    key = (z, x, y)
+    if key in worker_edges:
+        worker_edges.move_to_end(key)
+        return worker_edges[key]
+    tile_bytes = get_tile_bytes(z, x, y)
+    set_edges(key, None if tile_bytes is None else reduction.decode_tile_edges(tile_bytes, buffers))
+    return worker_edges[key]
+
+def set_edges(key, edges):
+    worker_edges[key] = edges
+    worker_edges.move_to_end(key)
+    if len(worker_edges) > edge_cache_size:
+        worker_edges.popitem(last=False)
+
+def read_halo(parent_x, parent_y, parent_z, buffers):
+    '''
+    fills the mosaic of the antialias filter with the children in buffers and the ring of their neighbors
+    '''
+    reduction.fill_mosaic(buffers)
+    child_z = parent_z + 1
+    num_tiles = 2 ** child_z
     for row_offset in range(2):
         for col_offset in range(2):
-            child_x = 2 * parent_x + col_offset
+            set_edges((child_z, 2 * parent_x + col_offset, 2 * parent_y + row_offset), reduction.get_child_edges(row_offset, col_offset, buffers))
+    for row_offset in range(-1, 3):
+        for col_offset in range(-1, 3):
+            if row_offset in (0, 1) and col_offset in (0, 1):
+                continue
             child_y = 2 * parent_y + row_offset
-            child_z = parent_z + 1
-            child = mercantile.Tile(x=child_x, y=child_y, z=child_z)
-            if child not in tile_to_pmtiles_filename:
+            if child_y < 0 or child_y >= num_tiles:
                 continue
-            child_bytes = None
-            filename = tile_to_pmtiles_filename[child]
-            file_z, file_x, file_y, _ = [int(a) for a in filename.replace('.pmtiles', '').split('-')]
-            pmtiles_folder = utils.get_pmtiles_folder(file_x, file_y, file_z)
-            with open(f'{pmtiles_folder}/{filename}' , 'r+b') as f:
-                reader = Reader(MmapSource(f))
-                child_bytes = reader.get(child_z, child_x, child_y)
-            child_rgb = np.array(Image.open(io.BytesIO(child_bytes)), dtype=np.float32)
-            row_start = 512 * row_offset
-            row_end = 512 * (row_offset + 1)
-            col_start = 512 * col_offset
-            col_end = 512 * (col_offset + 1)
-            # (red * 256 + green + blue / 256) - 32768
-            full_data[row_start:row_end, col_start:col_end] = child_rgb[:, :, 0] * 256.0 + child_rgb[:, :, 1] + child_rgb[:, :, 2] / 256.0 - 32768.0
-            
-    parent_data = full_data.reshape((512, 2, 512, 2)).mean(axis=(1, 3)) # downsample by 4x4 pixel averaging
-
-    parent_data += 32768.0
-    parent_rgb = np.zeros((512, 512, 3), dtype=np.uint8)
-    parent_rgb[:, :, 0] = parent_data // 256
-    parent_rgb[:, :, 1] = np.floor(parent_data % 256)
-    parent_rgb[:, :, 2] = np.floor((parent_data - np.floor(parent_data)) * 256)
-
-    parent_bytes = imagecodecs.webp_encode(parent_rgb, lossless=True)
+            child_x = (2 * parent_x + col_offset) % num_tiles # the antimeridian wraps around
+            reduction.set_halo_tile(get_edges(child_z, child_x, child_y, buffers), row_offset, col_offset, buffers)
+    reduction.extend_halo(buffers, top=parent_y == 0, bottom=parent_y == num_tiles // 2 - 1)
+
+def write_parent_tile(parent_x, parent_y, parent_z, buffers, tmp_folder):
+    '''
+    reduces the children in buffers to the parent and writes it to tmp_folder unless none of its pixels is valid.
+    the terrarium rgb, state and mask of the parent stay in buffers until the next parent of the same zoom.
+    returns whether the parent was flat and reused an encoded tile, see webp.encode_constant.
+    '''
+    if downsampling_filter == 'antialias':
+        parent = reduction.reduce_antialias(buffers, masked_downsampling)
+    else:
+        parent = reduction.reduce_children(buffers, masked_downsampling)
+    parent_rgb = reduction.encode_parent(buffers)
+    if buffers['parent_state'] == reduction.missing:
+        return False
+
+    constant = parent.min() == parent.max()
+    if constant:
+        parent_bytes = webp.encode_constant(parent[0, 0])
+    else:
+        parent_bytes = webp.encode(parent_rgb)
     parent_filepath = f'{tmp_folder}/{parent_z}-{parent_x}-{parent_y}.webp'
     with open(parent_filepath, 'wb') as f:
         f.write(parent_bytes)
+    return constant
 
-def get_tile_to_pmtiles_filename(pmtiles_filenames):
-    tile_to_pmtiles_filename = {}
-    for pmtiles_filename in pmtiles_filenames:
-        pmtiles_z, pmtiles_x, pmtiles_y, child_zoom = [int(a) for a in pmtiles_filename.replace('.pmtiles', '').split('-')]
-        children = None
-        if pmtiles_z == child_zoom:
-            children = [mercantile.Tile(x=pmtiles_x, y=pmtiles_y, z=pmtiles_z)]
-        else:
-            children = list(mercantile.children(mercantile.Tile(x=pmtiles_x, y=pmtiles_y, z=pmtiles_z), zoom=child_zoom))
-        for child in children:
-            tile_to_pmtiles_filename[child] = pmtiles_filename
-    return tile_to_pmtiles_filename
+def create_tile(parent_x, parent_y, parent_z, tmp_folder):
+    buffers = get_worker_buffers(parent_z)
+    for row_offset in range(2):
+        for col_offset in range(2):
+            tile_bytes = get_tile_bytes(parent_z + 1, 2 * parent_x + col_offset, 2 * parent_y + row_offset)
+            reduction.decode_child(tile_bytes, row_offset, col_offset, buffers)
+    if downsampling_filter == 'antialias':
+        read_halo(parent_x, parent_y, parent_z, buffers)
+    return write_parent_tile(parent_x, parent_y, parent_z, buffers, tmp_folder)
+
+def init_pyramid_worker(archive_index, item_index, max_zoom):
+    global worker_item_index, worker_max_zoom
+    init_worker(archive_index)
+    worker_item_index = item_index
+    worker_max_zoom = max_zoom
+
+def create_pyramid_tile(parent_x, parent_y, parent_z):
+    '''
+    creates the parent and, depth first, all its descendants up to worker_max_zoom that belong to an item of this pass.
+    children created in this pass are reduced from memory, all others are read from the archives.
+    returns the buffers of parent_z, whose terrarium rgb decodes to exactly what the next zoom would read from the archive,
+    the number of tiles created and how many of them were flat. the mask of partial parents is only kept in memory.
+    '''
+    buffers = get_worker_buffers(parent_z)
+    num_tiles = 1
+    num_constant = 0
+    for row_offset in range(2):
+        for col_offset in range(2):
+            child_x = 2 * parent_x + col_offset
+            child_y = 2 * parent_y + row_offset
+            child_z = parent_z + 1
+            if child_z <= worker_max_zoom and find_archive(child_z, child_x, child_y, worker_item_index) is not None:
+                child_buffers, num_child_tiles, num_child_constant = create_pyramid_tile(child_x, child_y, child_z)
+                # copied right away, the next sibling reuses the buffers of child_z
+                reduction.set_child(child_buffers['parent_rgb'], row_offset, col_offset, buffers, child_buffers['parent_state'], child_buffers['parent_mask'])
+                num_tiles += num_child_tiles
+                num_constant += num_child_constant
+            else:
+                reduction.decode_child(get_tile_bytes(child_z, child_x, child_y), row_offset, col_offset, buffers)
+    tmp_folder = find_archive(parent_z, parent_x, parent_y, worker_item_index)
+    if write_parent_tile(parent_x, parent_y, parent_z, buffers, tmp_folder):
+        num_constant += 1
+    return buffers, num_tiles, num_constant
+
+def create_pyramid_unit(unit):
+    parent_x, parent_y, parent_z = unit
+    return create_pyramid_tile(parent_x, parent_y, parent_z)[1:]
+
+
+def write_item_archive(tmp_folder, out_filepath):
+    '''
+    masked downsampling can leave an item without tiles. pmtiles archives cannot be empty, so it gets no archive.
+    '''
+    if len(glob(f'{tmp_folder}/*.webp')) == 0:
+        if os.path.isfile(out_filepath):
+            os.remove(out_filepath)
+        return
+    utils.create_archive(tmp_folder, out_filepath)
 
 def main(filepaths):
     for j, filepath in enumerate(filepaths):
@@ -97,16 +315,114 @@ def main(filepaths):
         
         argument_tuples = []
         for parent in parents:
-            argument_tuples.append((parent.x, parent.y, parent.z, aggregation_id, tmp_folder, pmtiles_filenames))
+            argument_tuples.append((parent.x, parent.y, parent.z, tmp_folder))
+
+        archive_index = get_archive_index(pmtiles_filenames)
+        if downsampling_filter == 'antialias':
+            # the halo reaches into the children of neighboring items
+            archive_index = get_zoom_archive_index(aggregation_id, parent_zoom + 1)
 
-        with Pool() as pool:
-            pool.starmap(create_tile, argument_tuples)
+        with Pool(initializer=init_worker, initargs=(archive_index,)) as pool:
+            num_constant = sum(pool.starmap(create_tile, argument_tuples))
+        print(f'{len(argument_tuples)} tiles, {num_constant} constant tiles reused an encoded tile.')
         
-        utils.create_archive(tmp_folder, out_filepath)
+        write_item_archive(tmp_folder, out_filepath)
 
         shutil.rmtree(tmp_folder)
         utils.run_command(f'touch {filepath.replace("-downsampling.csv", "-downsampling.done")}')
 
+def read_item(filepath):
+    _, aggregation_id, filename = filepath.split('/')
+    extent_z, extent_x, extent_y, parent_zoom = [int(a) for a in filename.split('-')[:4]]
+    with open(filepath) as f:
+        pmtiles_filenames = f.readlines()
+        pmtiles_filenames = pmtiles_filenames[1:] # skip header
+        pmtiles_filenames = [a.strip() for a in pmtiles_filenames]
+    return {
+        'filepath': filepath,
+        'extent': mercantile.Tile(x=extent_x, y=extent_y, z=extent_z),
+        'parent_zoom': parent_zoom,
+        'pmtiles_filenames': pmtiles_filenames,
+        'tmp_folder': filepath.replace('-downsampling.csv', '-tmp'),
+    }
+
+def get_item_parents(item):
+    if item['extent'].z == item['parent_zoom']:
+        return [item['extent']]
+    return list(mercantile.children(item['extent'], zoom=item['parent_zoom']))
+
+def get_pass(items, max_zoom, height):
+    '''
+    the items of the pass over the zooms max_zoom - height + 1 to max_zoom, their index and the units the pass starts from,
+    the parents whose own parent is not created in the same pass
+    '''
+    pass_items = [item for item in items if item['parent_zoom'] > max_zoom - height]
+    pass_items.sort(key=lambda item: item['parent_zoom'])
+    min_zoom = pass_items[0]['parent_zoom']
+
+    item_index = {}
+    for item in pass_items:
+        extent = item['extent']
+        item_index[(extent.z, extent.x, extent.y, item['parent_zoom'])] = item['tmp_folder']
+
+    units = []
+    for item in pass_items:
+        parents = get_item_parents(item)
+        first = parents[0]
+        if first.z > min_zoom and find_archive(first.z - 1, first.x >> 1, first.y >> 1, item_index) is not None:
+            continue
+        units += [(parent.x, parent.y, parent.z) for parent in parents]
+    units.sort(key=lambda unit: zxy_to_tileid(unit[2], unit[0], unit[1]))
+    return pass_items, item_index, units
+
+def main_pyramid(filepaths):
+    '''
+    creates the items of filepaths, which can span several zooms, in passes of up to pyramid_height zooms from high to low.
+    a pass starts depth first from its units, see get_pass and min_pyramid_units.
+    '''
+    items = []
+    for filepath in filepaths:
+        if os.path.isfile(filepath.replace('-downsampling.csv', '-downsampling.done')):
+            print(f'{filepath.split("/")[-1]} already done...')
+            continue
+        items.append(read_item(filepath))
+
+    while len(items) > 0:
+        max_zoom = max([item['parent_zoom'] for item in items])
+        for height in range(pyramid_height, 0, -1):
+            pass_items, item_index, units = get_pass(items, max_zoom, height)
+            if len(units) >= min_pyramid_units:
+                break
+        items = [item for item in items if item['parent_zoom'] <= max_zoom - height]
+        min_zoom = pass_items[0]['parent_zoom']
+        print(f'downsampling zooms {min_zoom} to {max_zoom}, {len(pass_items)} items, {len(units)} units. {datetime.now()}.')
+
+        pmtiles_filenames = set({})
+        for item in pass_items:
+            pmtiles_filenames |= set(item['pmtiles_filenames'])
+            utils.create_folder(item['tmp_folder'])
+
+        num_tiles = 0
+        num_constant = 0
+        max_unit_tiles = 0
+        with Pool(initializer=init_pyramid_worker, initargs=(get_archive_index(pmtiles_filenames), item_index, max_zoom)) as pool:
+            for j, (num_unit_tiles, num_unit_constant) in enumerate(pool.imap_unordered(create_pyramid_unit, units)):
+                num_tiles += num_unit_tiles
+                num_constant += num_unit_constant
+                max_unit_tiles = max(max_unit_tiles, num_unit_tiles)
+                if j % 100 == 0:
+                    print(f'{j} / {len(units)} units, {num_tiles} tiles')
+        print(f'{num_tiles} tiles, {num_constant} constant tiles reused an encoded tile, largest unit {max_unit_tiles} tiles.')
+
+        # high zooms first, a rerun after a crash while writing then still finds the children of every missing archive
+        for item in reversed(pass_items):
+            extent = item['extent']
+            out_folder = utils.get_pmtiles_folder(extent.x, extent.y, extent.z)
+            utils.create_folder(out_folder)
+            write_item_archive(item['tmp_folder'], f'{out_folder}/{extent.z}-{extent.x}-{extent.y}-{item["parent_zoom"]}.pmtiles')
+            shutil.rmtree(item['tmp_folder'])
+            utils.run_command(f'touch {item["filepath"].replace("-downsampling.csv", "-downsampling.done")}')
+
 def tiles_intersect(a, b):
     if a == b:
         return True
@@ -117,9 +433,12 @@ def tiles_intersect(a, b):
     return False
 
 def is_parent_of_dirty_aggregation_tile(tile, dirty_aggregation_tiles):
+    # the antialias halo reaches into the neighboring extents
+    tiles = [tile] + (mercantile.neighbors(tile) if downsampling_filter == 'antialias' else [])
     for dirty_aggregation_tile in dirty_aggregation_tiles:
-        if tiles_intersect(dirty_aggregation_tile, tile):
-            return True
+        for candidate in tiles:
+            if tiles_intersect(dirty_aggregation_tile, candidate):
+                return True
     return False
 
 if __name__ == '__main__':
@@ -130,6 +449,8 @@ if __name__ == '__main__':
     dirty_aggregation_tiles = []
     if len(aggregation_ids) >= 2:
         dirty_aggregation_filenames = utils.get_dirty_aggregation_filenames(aggregation_id, aggregation_ids[-2])
+        # the parents of removed items lose data and have to be recreated as well
+        dirty_aggregation_filenames += utils.get_removed_aggregation_filenames(aggregation_id, aggregation_ids[-2])
         for filename in dirty_aggregation_filenames:
             z, x, y, _ = [int(a) for a in filename.replace('-aggregation.csv', '').split('-')]
             dirty_aggregation_tiles.append(mercantile.Tile(x=x, y=y, z=z))
@@ -143,6 +464,9 @@ if __name__ == '__main__':
                 child_zoom_to_filepaths[child_zoom] = []
             child_zoom_to_filepaths[child_zoom].append(filepath)
 
-    child_zooms = list(reversed(sorted(list(child_zoom_to_filepaths.keys()))))
-    for child_zoom in child_zooms:
-        main(child_zoom_to_filepaths[child_zoom])
+    if downsampling_mode == 'pyramid' and downsampling_filter == 'box':
+        main_pyramid([filepath for child_zoom in child_zoom_to_filepaths for filepath in child_zoom_to_filepaths[child_zoom]])
+    else:
+        child_zooms = list(reversed(sorted(list(child_zoom_to_filepaths.keys()))))
+        for child_zoom in child_zooms:
+            main(child_zoom_to_filepaths[child_zoom])
@@ -0,0 +1,306 @@
+import io
+import sys
+import time
+
+import numpy as np
+from PIL import Image
+import imagecodecs
+
+import terrarium
+import webp
+
+# terrarium rgb of 0 m, missing children are reduced as sea level unless the reduction is masked
+zero_rgb = terrarium.encode(np.zeros((1, 1), dtype=np.float32))[0, 0]
+
+# validity of a child or parent tile. 'partial' tiles carry a pixel mask, see reduce_children.
+valid = 'valid'
+missing = 'missing'
+partial = 'partial'
+
+# mosaic rows (or columns) and the rows of the source tile for the child offsets -1 to 2 of the 4x4 halo grid,
+# see set_halo_tile. the mosaic has a border of one pixel around the 2x2 children.
+halo_mosaic_slices = {-1: slice(0, 1), 0: slice(1, 513), 1: slice(513, 1025), 2: slice(1025, 1026)}
+
+def get_buffers():
+    '''
+    per worker buffers, reused for every parent. children holds the four child tiles by (row, col) as terrarium rgb
+    plus an unused fourth byte, so that every pixel can be read as one 32 bit word.
+    '''
+    return {
+        'children': np.empty((2, 2, 512, 512, 4), dtype=np.uint8),
+        'states': [[valid, valid], [valid, valid]],
+        'masks': np.empty((2, 2, 512, 512), dtype=bool),
+        'packed': np.empty((512, 512), dtype=np.uint32),
+        'values': np.empty((512, 512), dtype=np.int32),
+        'value_sums': np.empty((256, 256), dtype=np.int32),
+        'count_sums': np.empty((256, 256), dtype=np.int32),
+        'parent': np.empty((512, 512), dtype=np.float32),
+        'parent_mask': np.empty((512, 512), dtype=bool),
+        'parent_state': valid,
+        'parent_rgb': np.empty((512, 512, 3), dtype=np.uint8),
+        'encode_scratch': np.empty((2, 512, 512), dtype=np.float32),
+        # antialias filter only
+        'mosaic': np.empty((1026, 1026), dtype=np.float32),
+        'mosaic_mask': np.empty((1026, 1026), dtype=np.float32),
+        'rows': np.empty((1026, 512), dtype=np.float32),
+        'taps': np.empty((1026, 512), dtype=np.float32),
+        'weights': np.empty((512, 512), dtype=np.float32),
+        'halo_rgba': np.empty((512, 512, 4), dtype=np.uint8),
+    }
+
+def decode_child(tile_bytes, row_offset, col_offset, buffers):
+    '''
+    decodes a webp tile straight into the children buffer, None marks a missing child
+    '''
+    out = buffers['children'][row_offset, col_offset]
+    if tile_bytes is None:
+        out[..., :3] = zero_rgb
+        buffers['states'][row_offset][col_offset] = missing
+    else:
+        imagecodecs.webp_decode(tile_bytes, hasalpha=True, out=out)
+        buffers['states'][row_offset][col_offset] = valid
+
+def set_child(rgb, row_offset, col_offset, buffers, state=valid, mask=None):
+    '''
+    copies a child that is already decoded to terrarium rgb into the children buffer, mask is needed for partial children
+    '''
+    buffers['children'][row_offset, col_offset, ..., :3] = rgb
+    buffers['states'][row_offset][col_offset] = state
+    if state == partial:
+        buffers['masks'][row_offset, col_offset] = mask
+
+def get_child_mask(row_offset, col_offset, buffers):
+    state = buffers['states'][row_offset][col_offset]
+    if state == partial:
+        return buffers['masks'][row_offset, col_offset]
+    return state == valid
+
+def set_parent_state(buffers):
+    if buffers['parent_mask'].all():
+        buffers['parent_state'] = valid
+    elif buffers['parent_mask'].any():
+        buffers['parent_state'] = partial
+    else:
+        buffers['parent_state'] = missing
+    return buffers['parent_state']
+
+def reduce_children(buffers, masked=False):
+    '''
+    averages 2x2 child pixels into the parent elevations, decoding terrarium on the way.
+    each pixel is read as the 24 bit terrarium value red * 65536 + green * 256 + blue in 1/256 m, sums of four fit into int32.
+    every partial sum of the float reduction it replaces is exactly representable in float32 for elevations
+    below 16384 m, so the result is bit identical to decoding to float32 first and averaging afterwards.
+
+    masked averages only the valid pixels of the children and sets parent_mask and parent_state, parent pixels without
+    any valid child pixel are 0. valid children take the same path as the unmasked reduction.
+    returns the parent elevations.
+    '''
+    packed = buffers['packed']
+    values = buffers['values']
+    value_sums = buffers['value_sums']
+    count_sums = buffers['count_sums']
+    parent = buffers['parent']
+    for row_offset in range(2):
+        for col_offset in range(2):
+            state = buffers['states'][row_offset][col_offset]
+            quadrant = parent[256 * row_offset:256 * (row_offset + 1), 256 * col_offset:256 * (col_offset + 1)]
+            quadrant_mask = buffers['parent_mask'][256 * row_offset:256 * (row_offset + 1), 256 * col_offset:256 * (col_offset + 1)]
+            if masked and state == missing:
+                quadrant[:] = 0.0
+                quadrant_mask[:] = False
+                continue
+
+            # the little endian word of the bytes red, green, blue, x is x << 24 | blue << 16 | green << 8 | red
+            np.copyto(packed, buffers['children'][row_offset, col_offset].view(np.uint32)[..., 0])
+            if sys.byteorder == 'little':
+                packed.byteswap(inplace=True)
+            np.right_shift(packed, 8, out=values, casting='unsafe')
+
+            if masked and state == partial:
+                mask = buffers['masks'][row_offset, col_offset]
+                np.subtract(values, 32768 * 256, out=values)
+                np.multiply(values, mask, out=values)
+                np.add(values[0::2, 0::2], values[0::2, 1::2], out=value_sums)
+                np.add(value_sums, values[1::2, 0::2], out=value_sums)
+                np.add(value_sums, values[1::2, 1::2], out=value_sums)
+                np.add(mask[0::2, 0::2], mask[0::2, 1::2], out=count_sums, dtype=np.int32)
+                np.add(count_sums, mask[1::2, 0::2], out=count_sums)
+                np.add(count_sums, mask[1::2, 1::2], out=count_sums)
+                np.greater(count_sums, 0, out=quadrant_mask)
+                np.multiply(count_sums, 256, out=count_sums)
+                quadrant[:] = 0.0
+                np.divide(value_sums, count_sums, out=quadrant, where=quadrant_mask)
+                continue
+
+            np.add(values[0::2, 0::2], values[0::2, 1::2], out=value_sums)
+            np.add(value_sums, values[1::2, 0::2], out=value_sums)
+            np.add(value_sums, values[1::2, 1::2], out=value_sums)
+            # minus 4 * 32768 * 256 for the terrarium offset of the four pixels
+            np.subtract(value_sums, 4 * 32768 * 256, out=value_sums)
+
+            np.multiply(value_sums, 1.0 / 1024.0, out=quadrant, dtype=np.float32)
+            quadrant_mask[:] = True
+    if masked:
+        set_parent_state(buffers)
+    else:
+        buffers['parent_state'] = valid
+    return parent
+
+def fill_mosaic(buffers):
+    '''
+    decodes the 2x2 children into the inner 1024x1024 pixels of the mosaic and its mask
+    '''
+    for row_offset in range(2):
+        for col_offset in range(2):
+            rows = halo_mosaic_slices[row_offset]
+            cols = halo_mosaic_slices[col_offset]
+            terrarium.decode(buffers['children'][row_offset, col_offset, ..., :3], out=buffers['mosaic'][rows, cols], scratch=buffers['weights'])
+            buffers['mosaic_mask'][rows, cols] = get_child_mask(row_offset, col_offset, buffers)
+
+def get_tile_edges(elevations):
+    '''
+    the first and last row and column of a tile, all that neighbors need from it for their halo
+    '''
+    return elevations[[0, 511], :].copy(), elevations[:, [0, 511]].copy()
+
+def decode_tile_edges(tile_bytes, buffers):
+    '''
+    edges of a webp tile that is not one of the children, only the edge pixels are decoded to elevations
+    '''
+    rgba = buffers['halo_rgba']
+    imagecodecs.webp_decode(tile_bytes, hasalpha=True, out=rgba)
+    return terrarium.decode(rgba[[0, 511], :, :3]), terrarium.decode(rgba[:, [0, 511], :3])
+
+def get_child_edges(row_offset, col_offset, buffers):
+    '''
+    edges of a child after fill_mosaic, None for missing children
+    '''
+    if buffers['states'][row_offset][col_offset] == missing:
+        return None
+    return get_tile_edges(buffers['mosaic'][halo_mosaic_slices[row_offset], halo_mosaic_slices[col_offset]])
+
+def set_halo_tile(edges, row_offset, col_offset, buffers):
+    '''
+    copies the pixels of the neighboring child at (row_offset, col_offset) in -1 to 2 that touch the 2x2 children
+    into the border of the mosaic. None marks a missing neighbor.
+    '''
+    rows = halo_mosaic_slices[row_offset]
+    cols = halo_mosaic_slices[col_offset]
+    if edges is None:
+        buffers['mosaic'][rows, cols] = 0.0
+        buffers['mosaic_mask'][rows, cols] = 0.0
+        return
+    edge_rows, edge_cols = edges
+    if row_offset in (-1, 2):
+        edge = edge_rows[1 if row_offset == -1 else 0]
+        if col_offset in (-1, 2):
+            edge = edge[511 if col_offset == -1 else 0]
+        buffers['mosaic'][rows, cols] = edge
+    else:
+        buffers['mosaic'][rows, cols] = edge_cols[:, 1 if col_offset == -1 else 0][:, np.newaxis]
+    buffers['mosaic_mask'][rows, cols] = 1.0
+
+def extend_halo(buffers, top, bottom):
+    '''
+    repeats the outermost rows of the children at the north and south edges of the world, where there are no neighbors
+    '''
+    if top:
+        buffers['mosaic'][0] = buffers['mosaic'][1]
+        buffers['mosaic_mask'][0] = buffers['mosaic_mask'][1]
+    if bottom:
+        buffers['mosaic'][1025] = buffers['mosaic'][1024]
+        buffers['mosaic_mask'][1025] = buffers['mosaic_mask'][1024]
+
+def apply_tent(data, out, buffers):
+    '''
+    separable [1, 3, 3, 1] / 8 filter of the 1026x1026 mosaic sampled at every second pixel, out is 512x512.
+    parent pixel p covers the child pixels 2p and 2p + 1 like the box filter and reaches one pixel further on each side.
+    '''
+    rows = buffers['rows']
+    taps = buffers['taps']
+    np.add(data[:, 0:1024:2], data[:, 3:1026:2], out=rows)
+    np.add(data[:, 1:1025:2], data[:, 2:1026:2], out=taps)
+    np.multiply(taps, 3.0, out=taps)
+    np.add(rows, taps, out=rows)
+
+    np.add(rows[0:1024:2], rows[3:1026:2], out=out)
+    np.add(rows[1:1025:2], rows[2:1026:2], out=taps[:512])
+    np.multiply(taps[:512], 3.0, out=taps[:512])
+    np.add(out, taps[:512], out=out)
+    np.multiply(out, 1.0 / 64.0, out=out)
+    return out
+
+def reduce_antialias(buffers, masked=False):
+    '''
+    tent filtered parent of the mosaic, see fill_mosaic and set_halo_tile. masked normalizes the filter weights
+    by the valid pixels below every parent pixel, otherwise missing tiles count as 0 m.
+    returns the parent elevations.
+    '''
+    parent = buffers['parent']
+    if not masked:
+        apply_tent(buffers['mosaic'], parent, buffers)
+        buffers['parent_mask'][:] = True
+        buffers['parent_state'] = valid
+        return parent
+
+    weights = buffers['weights']
+    np.multiply(buffers['mosaic'], buffers['mosaic_mask'], out=buffers['mosaic'])
+    apply_tent(buffers['mosaic'], parent, buffers)
+    apply_tent(buffers['mosaic_mask'], weights, buffers)
+    # the smallest non zero weight is 1 / 64 for a single valid corner pixel
+    np.greater(weights, 0.5 / 64.0, out=buffers['parent_mask'])
+    np.divide(parent, weights, out=parent, where=buffers['parent_mask'])
+    np.multiply(parent, buffers['parent_mask'], out=parent)
+    set_parent_state(buffers)
+    return parent
+
+def encode_parent(buffers):
+    return terrarium.encode(buffers['parent'], out=buffers['parent_rgb'], scratch=buffers['encode_scratch'])
+
+def reduce_reference(children_bytes):
+    '''
+    the previous implementation, kept for the benchmark: pil decode, float decode, reshape mean and encode
+    '''
+    full_data = np.zeros((1024, 1024), dtype=np.float32)
+    for j, child_bytes in enumerate(children_bytes):
+        if child_bytes is None:
+            continue
+        row_offset, col_offset = divmod(j, 2)
+        child_rgb = np.asarray(Image.open(io.BytesIO(child_bytes)))
+        terrarium.decode(child_rgb, out=full_data[512 * row_offset:512 * (row_offset + 1), 512 * col_offset:512 * (col_offset + 1)])
+    parent_data = full_data.reshape((512, 2, 512, 2)).mean(axis=(1, 3))
+    return terrarium.encode(parent_data)
+
+def reduce_fused(children_bytes, buffers):
+    for j, child_bytes in enumerate(children_bytes):
+        decode_child(child_bytes, j // 2, j % 2, buffers)
+    reduce_children(buffers)
+    return encode_parent(buffers)
+
+def benchmark(pmtiles_filepath=None, num_parents=32):
+    tiles = [webp.encode(rgb) for rgb in webp.get_benchmark_tiles(4 * num_parents, pmtiles_filepath)]
+    tiles += [None] * (4 * num_parents - len(tiles))
+    parents = [tiles[4 * j:4 * (j + 1)] for j in range(num_parents)]
+    # one parent with missing children
+    parents[0] = [parents[0][0], None, None, parents[0][3]]
+    buffers = get_buffers()
+
+    for children_bytes in parents:
+        assert np.array_equal(reduce_reference(children_bytes), reduce_fused(children_bytes, buffers))
+
+    t1 = time.time()
+    for children_bytes in parents:
+        reduce_reference(children_bytes)
+    t_reference = time.time() - t1
+
+    t1 = time.time()
+    for children_bytes in parents:
+        reduce_fused(children_bytes, buffers)
+    t_fused = time.time() - t1
+
+    print(f'reference: {num_parents / t_reference:.1f} parents/s per core')
+    print(f'fused: {num_parents / t_fused:.1f} parents/s per core')
+    print('webp encoding of the parent is not included in either, see webp.py')
+
+if __name__ == '__main__':
+    benchmark(sys.argv[1] if len(sys.argv) > 1 else None)
@@ -1,18 +1,29 @@
 from glob import glob
+import os
 
 import utils
 
-aggregation_id = utils.get_aggregation_ids()[-1]
+aggregation_ids = utils.get_aggregation_ids()
+aggregation_id = aggregation_ids[-1]
 
 filepaths = glob(f'aggregation-store/{aggregation_id}/*-aggregation.csv')
 filepaths += glob(f'aggregation-store/{aggregation_id}/*-downsampling.csv')
 
-expected_pmtiles_filenames = []
+expected_pmtiles_filenames = set({})
 for filepath in filepaths:
     filename = filepath.split('/')[-1]
-    expected_pmtiles_filenames.append(filename.replace('-aggregation.csv', '.pmtiles').replace('-downsampling.csv', '.pmtiles'))
+    expected_pmtiles_filenames.add(filename.replace('-aggregation.csv', '.pmtiles').replace('-downsampling.csv', '.pmtiles'))
 
 pmtiles_filepaths = glob(f'pmtiles-store/*.pmtiles')
+
+# archives of removed aggregation items live in the per z7 subfolders, the manifest lists them without a scan
+if len(aggregation_ids) >= 2:
+    for filename in utils.get_removed_aggregation_filenames(aggregation_id, aggregation_ids[-2]):
+        z, x, y, child_z = [int(a) for a in filename.replace('-aggregation.csv', '').split('-')]
+        pmtiles_filepath = f'{utils.get_pmtiles_folder(x, y, z)}/{z}-{x}-{y}-{child_z}.pmtiles'
+        if os.path.isfile(pmtiles_filepath) and pmtiles_filepath not in pmtiles_filepaths:
+            pmtiles_filepaths.append(pmtiles_filepath)
+
 for pmtiles_filepath in pmtiles_filepaths:
     pmtiles_filename = pmtiles_filepath.split('/')[-1]
     if pmtiles_filename not in expected_pmtiles_filenames:
@@ -1,9 +1,59 @@
 from glob import glob
+from multiprocessing import Pool
+import tempfile
 import sys
+import os
 
 import rasterio
 from rasterio.warp import transform_bounds
-  
+
+# filename,size,mtime_ns followed by the bounds.csv columns of every file seen in the last run.
+# ends with .csv so that it is skipped like bounds.csv when listing the source rasters.
+cache_filename = 'bounds-cache.csv'
+
+def get_bounds_line(filepath):
+    with rasterio.open(filepath) as src:
+        left, bottom, right, top = transform_bounds(src.crs, 'EPSG:3857', *src.bounds)
+        filename = filepath.split('/')[-1]
+        return f'{filename},{left},{bottom},{right},{top},{src.width},{src.height},{src.crs}\n'
+
+def get_file_signature(filepath):
+    stat = os.stat(filepath)
+    return stat.st_size, stat.st_mtime_ns
+
+def read_cache(source):
+    '''
+    returns {filename: (size, mtime_ns, bounds_line)}
+    '''
+    cache = {}
+    filepath = f'source-store/{source}/{cache_filename}'
+    if not os.path.isfile(filepath):
+        return cache
+    with open(filepath) as f:
+        f.readline() # skip header
+        for line in f:
+            filename, size, mtime_ns, bounds_line = line.split(',', 3)
+            cache[filename] = (int(size), int(mtime_ns), f'{filename},{bounds_line}')
+    return cache
+
+def write_atomically(filepath, lines):
+    '''
+    writes to a hidden temporary file in the same folder and renames it, readers never see a truncated file.
+    mkstemp creates the file as 0600, it gets the permissions of a plain open instead.
+    '''
+    folder, filename = os.path.split(filepath)
+    fd, tmp_filepath = tempfile.mkstemp(dir=folder, prefix=f'.{filename}-')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.writelines(lines)
+        umask = os.umask(0)
+        os.umask(umask)
+        os.chmod(tmp_filepath, 0o666 & ~umask)
+        os.replace(tmp_filepath, filepath)
+    except BaseException:
+        os.remove(tmp_filepath)
+        raise
+
 def main():
     source = None
     if len(sys.argv) > 1:
@@ -13,22 +63,37 @@ def main():
         print('source argument missing...')
         exit()
 
-    filepaths = sorted(glob(f'source-store/{source}/*'))
+    filepaths = [filepath for filepath in sorted(glob(f'source-store/{source}/*')) if not filepath.endswith('.csv')]
 
-    bounds_file_lines = ['filename,left,bottom,right,top,width,height,crs\n']
+    cache = read_cache(source)
+    signatures = {}
+    bounds_lines = {}
+    todo_filepaths = []
+    for filepath in filepaths:
+        filename = filepath.split('/')[-1]
+        signatures[filename] = get_file_signature(filepath)
+        if filename in cache and cache[filename][:2] == signatures[filename]:
+            bounds_lines[filename] = cache[filename][2]
+        else:
+            todo_filepaths.append(filepath)
+    print(f'{len(filepaths) - len(todo_filepaths)} files unchanged, opening {len(todo_filepaths)} files...')
 
-    for j, filepath in enumerate(filepaths):
-        if filepath.endswith('.csv'):
-            continue
-        with rasterio.open(filepath) as src:
-            left, bottom, right, top = transform_bounds(src.crs, 'EPSG:3857', *src.bounds)
-            filename = filepath.split('/')[-1]
-            bounds_file_lines.append(f'{filename},{left},{bottom},{right},{top},{src.width},{src.height},{src.crs}\n')
+    with Pool() as pool:
+        for j, bounds_line in enumerate(pool.imap(get_bounds_line, todo_filepaths, chunksize=16)):
+            bounds_lines[todo_filepaths[j].split('/')[-1]] = bounds_line
             if j % 100 == 0:
-                print(f'{j} / {len(filepaths)}')
+                print(f'{j} / {len(todo_filepaths)}')
+
+    bounds_file_lines = ['filename,left,bottom,right,top,width,height,crs\n']
+    cache_file_lines = ['filename,size,mtime_ns,left,bottom,right,top,width,height,crs\n']
+    for filepath in filepaths:
+        filename = filepath.split('/')[-1]
+        size, mtime_ns = signatures[filename]
+        bounds_file_lines.append(bounds_lines[filename])
+        cache_file_lines.append(f'{filename},{size},{mtime_ns},{bounds_lines[filename].split(",", 1)[1]}')
 
-    with open(f'source-store/{source}/bounds.csv', 'w') as f:
-        f.writelines(bounds_file_lines)
+    write_atomically(f'source-store/{source}/bounds.csv', bounds_file_lines)
+    write_atomically(f'source-store/{source}/{cache_filename}', cache_file_lines)
 
 
 if __name__ == '__main__':
@@ -1,17 +1,251 @@
-import utils
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit, urljoin
+import http.client
+import threading
+import hashlib
+import json
+import time
 import sys
+import os
+
+import utils
+
+download_threads = 8
+max_attempts = 5
+backoff_seconds = 2.0
+timeout_seconds = 60
+chunk_size = 1024 * 1024
+
+# filename,size,sha256 of every downloaded and verified file. ends with .csv so that source_bounds skips it.
+manifest_filename = 'download-manifest.csv'
+
+class DownloadError(Exception):
+    pass
+
+class PermanentDownloadError(DownloadError):
+    '''
+    client errors like 404 that a retry will not fix
+    '''
+    pass
+
+thread_local = threading.local()
+
+def get_connection(scheme, netloc):
+    '''
+    one keep-alive connection per host and thread
+    '''
+    if not hasattr(thread_local, 'connections'):
+        thread_local.connections = {}
+    key = (scheme, netloc)
+    if key not in thread_local.connections:
+        if scheme == 'https':
+            thread_local.connections[key] = http.client.HTTPSConnection(netloc, timeout=timeout_seconds)
+        else:
+            thread_local.connections[key] = http.client.HTTPConnection(netloc, timeout=timeout_seconds)
+    return thread_local.connections[key]
+
+def close_connection(scheme, netloc):
+    connection = thread_local.connections.pop((scheme, netloc), None)
+    if connection is not None:
+        connection.close()
+
+def get_partial_filepath(filepath):
+    # hidden so that globs over the source folder never pick up incomplete files
+    folder, filename = os.path.split(filepath)
+    return f'{folder}/.{filename}.part'
+
+def send_request(parts, path, headers):
+    '''
+    sends the request on the keep-alive connection of the host. a reused connection that the server closed in the
+    meantime fails right away, it is reconnected once without counting as a failed attempt.
+    '''
+    for reconnect in (True, False):
+        connection = get_connection(parts.scheme, parts.netloc)
+        reused = connection.sock is not None
+        try:
+            connection.request('GET', path, headers=headers)
+            return connection.getresponse()
+        except (http.client.RemoteDisconnected, BrokenPipeError, ConnectionResetError):
+            close_connection(parts.scheme, parts.netloc)
+            if not (reconnect and reused):
+                raise
+        except (http.client.HTTPException, OSError):
+            close_connection(parts.scheme, parts.netloc)
+            raise
+
+def request(url, headers, max_redirects=5):
+    for _ in range(max_redirects + 1):
+        parts = urlsplit(url)
+        path = parts.path + (f'?{parts.query}' if parts.query else '')
+        response = send_request(parts, path, headers)
+        if response.status in (301, 302, 303, 307, 308):
+            response.read()
+            url = urljoin(url, response.getheader('Location'))
+            continue
+        return parts, response
+    raise DownloadError(f'too many redirects for {url}')
 
-def download_from_internet(source):
+def download_once(url, partial_filepath, expected):
+    '''
+    continues partial_filepath with a range request and returns its size and sha256 once complete
+    '''
+    offset = os.path.getsize(partial_filepath) if os.path.isfile(partial_filepath) else 0
+    headers = {'Range': f'bytes={offset}-'} if offset > 0 else {}
+    parts, response = request(url, headers)
+
+    total_size = None
+    if response.status == 416:
+        # the partial file is already complete
+        response.read()
+        content_range = response.getheader('Content-Range', '')
+        if content_range.startswith('bytes */'):
+            total_size = int(content_range.split('/')[-1])
+        if total_size != offset:
+            os.remove(partial_filepath)
+            raise DownloadError(f'range not satisfiable for {url}, restarting')
+    elif response.status in (200, 206):
+        mode = 'ab'
+        if response.status == 200:
+            # server ignored the range, start over
+            offset = 0
+            mode = 'wb'
+        content_length = response.getheader('Content-Length')
+        if content_length is not None:
+            total_size = offset + int(content_length)
+        try:
+            with open(partial_filepath, mode) as f:
+                while True:
+                    data = response.read(chunk_size)
+                    if not data:
+                        break
+                    f.write(data)
+        except (http.client.HTTPException, OSError):
+            close_connection(parts.scheme, parts.netloc)
+            raise
+    else:
+        response.read()
+        if 400 <= response.status < 500 and response.status not in (408, 429):
+            raise PermanentDownloadError(f'http status {response.status} for {url}')
+        raise DownloadError(f'http status {response.status} for {url}')
+
+    size = os.path.getsize(partial_filepath)
+    if total_size is not None and size != total_size:
+        close_connection(parts.scheme, parts.netloc)
+        raise DownloadError(f'{url} incomplete, {size} of {total_size} bytes')
+    if 'size' in expected and size != expected['size']:
+        os.remove(partial_filepath)
+        raise DownloadError(f'{url} has {size} bytes, expected {expected["size"]}')
+
+    sha256 = hashlib.sha256()
+    with open(partial_filepath, 'rb') as f:
+        for data in iter(lambda: f.read(chunk_size), b''):
+            sha256.update(data)
+    sha256 = sha256.hexdigest()
+    if 'sha256' in expected and sha256 != expected['sha256']:
+        os.remove(partial_filepath)
+        raise DownloadError(f'{url} checksum mismatch')
+    return size, sha256
+
+def download_file(url, filepath, expected):
+    '''
+    downloads url to filepath with retries and exponential backoff, resuming where the previous attempt stopped.
+    an existing filepath that is not in the manifest, e.g. from an older wget based run, is resumed like wget -c did.
+    '''
+    partial_filepath = get_partial_filepath(filepath)
+    if os.path.isfile(filepath) and not os.path.isfile(partial_filepath):
+        os.replace(filepath, partial_filepath)
+    for attempt in range(max_attempts):
+        try:
+            size, sha256 = download_once(url, partial_filepath, expected)
+            os.replace(partial_filepath, filepath)
+            return size, sha256
+        except (DownloadError, http.client.HTTPException, OSError) as e:
+            if attempt == max_attempts - 1 or isinstance(e, PermanentDownloadError):
+                raise DownloadError(f'giving up on {url}: {e}')
+            print(f'attempt {attempt + 1} for {url} failed: {e}')
+            time.sleep(backoff_seconds * 2 ** attempt)
+
+def read_manifest(folder):
+    manifest = {}
+    filepath = f'{folder}/{manifest_filename}'
+    if not os.path.isfile(filepath):
+        return manifest
+    with open(filepath) as f:
+        f.readline() # skip header
+        for line in f:
+            filename, size, sha256 = line.strip().split(',')
+            manifest[filename] = {'size': int(size), 'sha256': sha256}
+    return manifest
+
+def get_expected_files(catalog_folder):
+    '''
+    optional "files": {filename: {"size": ..., "sha256": ...}} in metadata.json
+    '''
+    filepath = f'{catalog_folder}/metadata.json'
+    if not os.path.isfile(filepath):
+        return {}
+    with open(filepath) as f:
+        return json.load(f).get('files', {})
+
+def get_urls(catalog_folder):
     urls = []
-    with open(f'../source-catalog/{source}/file_list.txt') as f:
+    with open(f'{catalog_folder}/file_list.txt') as f:
         line = f.readline().strip()
         while line != '':
             urls.append(line)
             line = f.readline().strip()
+    return urls
+
+def download(urls, folder, expected_files=None, num_threads=download_threads):
+    '''
+    downloads urls into folder. files listed in the manifest with matching size and expected values are skipped
+    without touching the network. returns the urls that failed.
+    '''
+    expected_files = {} if expected_files is None else expected_files
+    utils.create_folder(folder)
+    manifest = read_manifest(folder)
+    manifest_filepath = f'{folder}/{manifest_filename}'
+    if not os.path.isfile(manifest_filepath):
+        with open(manifest_filepath, 'w') as f:
+            f.write('filename,size,sha256\n')
+
+    todo = []
     for url in urls:
         filename = url.split('/')[-1]
-        command = f'wget --no-verbose -O source-store/{source}/{filename} -c {url}'
-        utils.run_command(command, silent=False)
+        expected = expected_files.get(filename, {})
+        if filename in manifest and os.path.isfile(f'{folder}/{filename}'):
+            entry = manifest[filename]
+            if os.path.getsize(f'{folder}/{filename}') == entry['size'] and all(entry[key] == value for key, value in expected.items()):
+                continue
+        todo.append((url, filename, expected))
+    print(f'{len(urls) - len(todo)} files already verified, downloading {len(todo)} files...')
+
+    manifest_lock = threading.Lock()
+    failed_urls = []
+    def download_item(item):
+        url, filename, expected = item
+        try:
+            size, sha256 = download_file(url, f'{folder}/{filename}', expected)
+        except DownloadError as e:
+            print(e)
+            return url
+        with manifest_lock:
+            with open(manifest_filepath, 'a') as f:
+                f.write(f'{filename},{size},{sha256}\n')
+        return None
+
+    with ThreadPoolExecutor(num_threads) as executor:
+        for j, failed_url in enumerate(executor.map(download_item, todo)):
+            if failed_url is not None:
+                failed_urls.append(failed_url)
+            if j % 100 == 0:
+                print(f'{j} / {len(todo)}')
+    return failed_urls
+
+def download_from_internet(source, catalog_folder=None, folder=None):
+    catalog_folder = f'../source-catalog/{source}' if catalog_folder is None else catalog_folder
+    folder = f'source-store/{source}' if folder is None else folder
+    return download(get_urls(catalog_folder), folder, get_expected_files(catalog_folder))
 
 def main():
     source = None
@@ -22,8 +256,12 @@ def main():
         print('source argument missing...')
         exit()
 
-    utils.create_folder( f'source-store/{source}/')
-    download_from_internet(source)
+    failed_urls = download_from_internet(source)
+    if len(failed_urls) > 0:
+        print(f'{len(failed_urls)} downloads failed:')
+        for url in failed_urls:
+            print(url)
+        exit(1)
 
 if __name__ == '__main__':
     main()
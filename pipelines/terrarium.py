@@ -0,0 +1,85 @@
+import time
+
+import numpy as np
+
+# 65535 + 255 / 256, the largest value that can be stored in a terrarium pixel
+max_value = 65535.99609375
+
+def encode(data, out=None, scratch=None):
+    '''
+    encodes elevations of shape (..., height, width) into terrarium rgb of shape (..., height, width, 3).
+    data is not modified. out (uint8) and scratch (float32 of shape (2, ...)) can be passed in to reuse buffers across calls.
+    rgb = floor((elevation + 32768) * 256) split into three bytes, values outside of the terrarium range are clipped.
+    '''
+    if out is None:
+        out = np.empty(data.shape + (3,), dtype=np.uint8)
+    if scratch is None:
+        scratch = np.empty((2,) + data.shape, dtype=np.float32)
+    value = scratch[0]
+    whole = scratch[1]
+
+    np.add(data, 32768.0, out=value, dtype=np.float32)
+    np.clip(value, 0.0, max_value, out=value)
+    np.floor(value, out=whole)
+
+    # blue: fractional part
+    np.subtract(value, whole, out=value)
+    np.multiply(value, 256.0, out=value)
+    np.copyto(out[..., 2], value, casting='unsafe')
+
+    # red: high byte
+    np.multiply(whole, 1.0 / 256.0, out=value)
+    np.floor(value, out=value)
+    np.copyto(out[..., 0], value, casting='unsafe')
+
+    # green: low byte
+    np.multiply(value, 256.0, out=value)
+    np.subtract(whole, value, out=value)
+    np.copyto(out[..., 1], value, casting='unsafe')
+
+    return out
+
+def decode(rgb, out=None, scratch=None):
+    '''
+    decodes terrarium rgb of shape (..., height, width, 3) into float32 elevations of shape (..., height, width).
+    out and scratch (both float32 of shape (..., height, width)) can be passed in to reuse buffers across calls.
+    elevation = red * 256 + green + blue / 256 - 32768
+    '''
+    if out is None:
+        out = np.empty(rgb.shape[:-1], dtype=np.float32)
+    if scratch is None:
+        scratch = np.empty(rgb.shape[:-1], dtype=np.float32)
+
+    np.multiply(rgb[..., 0], 256.0, out=out, dtype=np.float32)
+    np.add(out, rgb[..., 1], out=out, dtype=np.float32)
+    np.multiply(rgb[..., 2], 1.0 / 256.0, out=scratch, dtype=np.float32)
+    np.add(out, scratch, out=out)
+    np.subtract(out, 32768.0, out=out)
+
+    return out
+
+def benchmark(num_tiles=64, repetitions=10):
+    rng = np.random.default_rng(0)
+    data = rng.uniform(-500.0, 5000.0, (num_tiles, 512, 512)).astype(np.float32)
+    rgb = np.empty(data.shape + (3,), dtype=np.uint8)
+    scratch = np.empty((2,) + data.shape, dtype=np.float32)
+    decoded = np.empty(data.shape, dtype=np.float32)
+
+    encode(data, out=rgb, scratch=scratch)
+    t1 = time.time()
+    for _ in range(repetitions):
+        encode(data, out=rgb, scratch=scratch)
+    t_encode = time.time() - t1
+    print(f'encode: {int(num_tiles * repetitions / t_encode)} tiles/s')
+
+    decode(rgb, out=decoded, scratch=scratch[0])
+    t1 = time.time()
+    for _ in range(repetitions):
+        decode(rgb, out=decoded, scratch=scratch[0])
+    t_decode = time.time() - t1
+    print(f'decode: {int(num_tiles * repetitions / t_decode)} tiles/s')
+
+    assert np.all(np.abs(decoded - data) <= 1.0 / 256.0)
+
+if __name__ == '__main__':
+    benchmark()
@@ -0,0 +1,78 @@
+import numpy as np
+import pytest
+import rasterio
+from scipy import ndimage
+
+import aggregation_merge
+
+def get_binary_mask(shape, seed):
+    '''
+    valid pixels with blobs of nodata, some of which touch the raster edges
+    '''
+    rng = np.random.default_rng(seed)
+    holes = np.zeros(shape, dtype=bool)
+    holes[rng.integers(0, shape[0], 12), rng.integers(0, shape[1], 12)] = True
+    holes[0, shape[1] // 3] = True
+    holes[shape[0] // 2, -1] = True
+    holes = ndimage.binary_dilation(holes, iterations=8)
+    return ~holes
+
+def write_layer(filepath, data):
+    with rasterio.open(filepath, 'w', driver='GTiff', height=data.shape[0], width=data.shape[1], count=1, dtype='float32') as dst:
+        dst.write(data, 1)
+
+def merge(layer_filepaths, block_size, halo, max_pixel_distance, filter_size):
+    srcs = [rasterio.open(layer_filepath) for layer_filepath in layer_filepaths]
+    height = srcs[0].height
+    width = srcs[0].width
+    buffers = aggregation_merge.get_buffers((min(height, block_size + 2 * halo), min(width, block_size + 2 * halo)))
+    timings = {'read': 0.0, 'binary_mask': 0.0, 'alpha_mask': 0.0, 'merging': 0.0, 'skipped_blocks': 0}
+    merged = np.empty((height, width), dtype=np.float32)
+    for row in range(0, height, block_size):
+        for col in range(0, width, block_size):
+            core_window = rasterio.windows.Window(col_off=col, row_off=row, width=min(block_size, width - col), height=min(block_size, height - row))
+            merged[row:row + core_window.height, col:col + core_window.width] = aggregation_merge.merge_block(
+                srcs, None, core_window, halo, max_pixel_distance, filter_size, height, width, buffers, timings
+            )
+    for src in srcs:
+        src.close()
+    return merged
+
+@pytest.mark.parametrize('max_pixel_distance', [1, 5, 30])
+def test_distance_alpha_mask_matches_erosion(max_pixel_distance):
+    binary_mask = get_binary_mask((257, 311), max_pixel_distance)
+    filter_size = int(1.25 * max_pixel_distance)
+    buffers = aggregation_merge.get_buffers(binary_mask.shape)
+    erosion = aggregation_merge.get_alpha_mask_erosion(binary_mask, max_pixel_distance, filter_size, buffers).copy()
+    distance = aggregation_merge.get_alpha_mask_distance(binary_mask, max_pixel_distance, filter_size, (True, True, True, True), buffers)
+    np.testing.assert_allclose(distance, erosion, rtol=0, atol=1e-6)
+
+def test_blocked_distance_merge_matches_erosion_merge(tmp_path, monkeypatch):
+    shape = (300, 340)
+    rows, cols = np.mgrid[0:shape[0], 0:shape[1]].astype(np.float32)
+    layers = [
+        np.where(get_binary_mask(shape, 0), 1000 + rows, -9999).astype(np.float32),
+        np.where(get_binary_mask(shape, 1), 1010 + cols, -9999).astype(np.float32),
+        (990 + 0.5 * rows).astype(np.float32),
+    ]
+    layer_filepaths = []
+    for j, layer in enumerate(layers):
+        layer_filepaths.append(str(tmp_path / f'{j}.tiff'))
+        write_layer(layer_filepaths[-1], layer)
+    max_pixel_distance = 10
+    filter_size = int(1.25 * max_pixel_distance)
+    halo = (max_pixel_distance + filter_size // 2 + 1) * (len(layers) - 1)
+
+    monkeypatch.setattr(aggregation_merge, 'blending_mode', 'erosion')
+    erosion = merge(layer_filepaths, 512, halo, max_pixel_distance, filter_size)
+    monkeypatch.setattr(aggregation_merge, 'blending_mode', 'distance')
+    distance = merge(layer_filepaths, 512, halo, max_pixel_distance, filter_size)
+    blocked = merge(layer_filepaths, 64, halo, max_pixel_distance, filter_size)
+
+    assert (erosion != -9999).all()
+    np.testing.assert_allclose(distance, erosion, rtol=0, atol=1e-3)
+    # blocks without holes skip the blending that feathers the raster edges into the next layer. that only changes
+    # the buffer of 2 * max_pixel_distance pixels, which tiling crops away.
+    buffer_pixels = 2 * max_pixel_distance
+    tile_area = (slice(buffer_pixels, -buffer_pixels), slice(buffer_pixels, -buffer_pixels))
+    np.testing.assert_allclose(blocked[tile_area], erosion[tile_area], rtol=0, atol=1e-3)
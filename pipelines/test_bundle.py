@@ -0,0 +1,84 @@
+import os
+
+import pytest
+from pmtiles.reader import Reader, MmapSource, all_tiles
+
+import bundle
+import utils
+
+@pytest.fixture
+def store(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(bundle, 'tmp_folder', str(tmp_path))
+    utils.create_folder('pmtiles-store')
+    return tmp_path
+
+def write_archive(x, tile_bytes):
+    '''
+    writes the z2 children of the z1 tile (x, 0) with the given contents, returns the archive filepath
+    '''
+    tiles = [(2, 2 * x + col, row, tile_bytes[2 * row + col]) for row in range(2) for col in range(2)]
+    tiles.sort(key=lambda a: utils.zxy_to_tileid(a[0], a[1], a[2]))
+    filepath = f'pmtiles-store/1-{x}-0-2.pmtiles'
+    utils.write_archive(tiles, filepath)
+    return filepath
+
+def read_bundle(filepath):
+    with open(filepath, 'rb') as f:
+        source = MmapSource(f)
+        return {tuple(zxy): tile_bytes for zxy, tile_bytes in all_tiles(source)}, Reader(source).header()
+
+def test_flat_tiles_are_deduplicated_across_archives(store):
+    flat = b'f' * 54
+    relief = [os.urandom(1000) for _ in range(4)]
+    filepaths = [write_archive(0, [flat, relief[0], flat, relief[1]]), write_archive(1, [relief[2], flat, relief[3], flat])]
+    bundle.create_archive(filepaths, 'bundle.pmtiles')
+
+    tiles, header = read_bundle('bundle.pmtiles')
+    expected = {}
+    for filepath in filepaths:
+        expected.update(read_bundle(filepath)[0])
+    assert tiles == expected
+    assert header['tile_contents_count'] == 5
+    assert header['tile_data_length'] == len(flat) + 4 * 1000
+
+def test_evicted_contents_are_copied_again(store, monkeypatch):
+    monkeypatch.setattr(bundle, 'max_dedup_contents', 1)
+    sea = b's' * 54
+    lake = b'l' * 54
+    filepaths = [write_archive(0, [sea, lake, sea, lake]), write_archive(1, [sea, lake, sea, lake])]
+    bundle.create_archive(filepaths, 'bundle.pmtiles')
+
+    tiles, header = read_bundle('bundle.pmtiles')
+    assert tiles == {**read_bundle(filepaths[0])[0], **read_bundle(filepaths[1])[0]}
+    # only the most recent of sea and lake is still known when the second archive is copied
+    assert header['tile_contents_count'] == 3
+
+def test_bulk_copy_with_leaves_and_overlapping_archives(store, monkeypatch):
+    monkeypatch.setattr(bundle, 'target_root_length', 100)
+    monkeypatch.setattr(bundle, 'min_leaf_size', 16)
+    # 1-0-0-4 holds the z4 tiles of its extent, 0-0-0-4 those of the extent 1-1-0, their tile id ranges overlap
+    filepaths = []
+    for filename, extent_x in [('1-0-0-4', 0), ('0-0-0-4', 1)]:
+        tiles = []
+        for x in range(8 * extent_x, 8 * extent_x + 8):
+            for y in range(8):
+                tiles.append((4, x, y, os.urandom(300 + 7 * x + y)))
+        tiles.sort(key=lambda a: utils.zxy_to_tileid(a[0], a[1], a[2]))
+        filepaths.append(f'pmtiles-store/{filename}.pmtiles')
+        utils.write_archive(tiles, filepaths[-1])
+    filepaths.append(write_archive(0, [os.urandom(500) for _ in range(4)]))
+    bundle.create_archive(filepaths, 'bundle.pmtiles')
+
+    tiles, header = read_bundle('bundle.pmtiles')
+    expected = {}
+    for filepath in filepaths:
+        expected.update(read_bundle(filepath)[0])
+    assert len(tiles) == 132
+    assert tiles == expected
+    assert header['leaf_directory_length'] > 0
+    assert not header['clustered']
+    with open('bundle.pmtiles', 'rb') as f:
+        reader = Reader(MmapSource(f))
+        for (z, x, y), tile_bytes in expected.items():
+            assert reader.get(z, x, y) == tile_bytes
@@ -0,0 +1,84 @@
+import os
+
+import imagecodecs
+import numpy as np
+import pytest
+
+import downsampling_create
+import terrarium
+import utils
+import webp
+
+def write_world_archive(zoom, tiles):
+    '''
+    writes the tiles {(x, y): elevation} at zoom as constant tiles to the archive 0-0-0-{zoom}.pmtiles
+    '''
+    archive_tiles = []
+    for (x, y), elevation in tiles.items():
+        rgb = terrarium.encode(np.full((512, 512), elevation, dtype=np.float32))
+        archive_tiles.append((zoom, x, y, webp.encode(rgb)))
+    archive_tiles.sort(key=lambda a: utils.zxy_to_tileid(a[0], a[1], a[2]))
+    utils.create_folder(utils.get_pmtiles_folder(0, 0, 0))
+    utils.write_archive(archive_tiles, f'{utils.get_pmtiles_folder(0, 0, 0)}/0-0-0-{zoom}.pmtiles')
+
+def read_elevation(filepath):
+    with open(filepath, 'rb') as f:
+        rgb = imagecodecs.webp_decode(f.read())
+    return terrarium.decode(rgb[..., :3])
+
+@pytest.fixture
+def store(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(downsampling_create, 'masked_downsampling', False)
+    monkeypatch.setattr(utils, 'omit_empty_tiles', False)
+    yield tmp_path
+    downsampling_create.clear_archive_cache()
+
+def test_missing_archive_raises(store):
+    downsampling_create.init_worker({(0, 0, 0, 2): '0-0-0-2.pmtiles'})
+    with pytest.raises(FileNotFoundError):
+        downsampling_create.get_tile_bytes(2, 0, 0)
+
+@pytest.mark.parametrize('module, name', [(downsampling_create, 'masked_downsampling'), (utils, 'omit_empty_tiles')])
+def test_missing_archive_is_empty_when_tiles_can_be_left_out(store, monkeypatch, module, name):
+    monkeypatch.setattr(module, name, True)
+    downsampling_create.init_worker({(0, 0, 0, 2): '0-0-0-2.pmtiles'})
+    assert downsampling_create.get_tile_bytes(2, 0, 0) is None
+
+@pytest.mark.parametrize('masked', [False, True])
+def test_pyramid_leaves_out_missing_parents_when_masked(store, monkeypatch, masked):
+    monkeypatch.setattr(downsampling_create, 'masked_downsampling', masked)
+    write_world_archive(2, {(0, 0): 100.0})
+    item_index = {(0, 0, 0, 1): str(store / 'tmp-1'), (0, 0, 0, 0): str(store / 'tmp-0')}
+    for tmp_folder in item_index.values():
+        utils.create_folder(tmp_folder)
+    downsampling_create.init_pyramid_worker({(0, 0, 0, 2): '0-0-0-2.pmtiles'}, item_index, 1)
+    _, num_tiles, _ = downsampling_create.create_pyramid_tile(0, 0, 0)
+    assert num_tiles == 5
+
+    z1_filenames = sorted(os.listdir(store / 'tmp-1'))
+    assert z1_filenames == (['1-0-0.webp'] if masked else ['1-0-0.webp', '1-0-1.webp', '1-1-0.webp', '1-1-1.webp'])
+    z0 = read_elevation(store / 'tmp-0' / '0-0-0.webp')
+    assert (z0[:128, :128] == 100.0).all()
+    assert (z0[128:, :] == 0.0).all()
+    assert (z0[:, 128:] == 0.0).all()
+
+@pytest.mark.parametrize('masked', [False, True])
+def test_masked_antialias_keeps_data_edges(store, monkeypatch, masked):
+    monkeypatch.setattr(downsampling_create, 'downsampling_filter', 'antialias')
+    monkeypatch.setattr(downsampling_create, 'masked_downsampling', masked)
+    write_world_archive(1, {(0, 0): 100.0})
+    utils.create_folder(str(store / 'tmp'))
+    downsampling_create.init_worker({(0, 0, 0, 1): '0-0-0-1.pmtiles'})
+    downsampling_create.create_tile(0, 0, 0, str(store / 'tmp'))
+
+    parent = read_elevation(store / 'tmp' / '0-0-0.webp')
+    # the tent filter of the outer parent pixels of the child reaches into the missing neighbors,
+    # on the left across the antimeridian
+    if masked:
+        assert (parent[:256, :256] == 100.0).all()
+        assert (parent[257:, :] == 0.0).all()
+    else:
+        assert (parent[:255, 0] < 100.0).all()
+        assert (parent[:255, 255] < 100.0).all()
+        assert (parent[:255, 1:255] == 100.0).all()
@@ -0,0 +1,136 @@
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import hashlib
+import threading
+import os
+
+import pytest
+
+import source_download
+
+content = bytes(range(256)) * 1024
+
+class Handler(BaseHTTPRequestHandler):
+    '''
+    serves content at every path. server.plans[path] lists how the next requests are answered:
+    'truncate' sends half of the body and closes the connection, 'drop' closes the connection without a response,
+    an int is sent as error status, anything else serves normally.
+    '''
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self.server.requests.append((self.path, self.headers.get('Range')))
+        plan = self.server.plans.get(self.path, [])
+        behavior = plan.pop(0) if len(plan) > 0 else None
+
+        if behavior == 'drop':
+            self.close_connection = True
+            return
+        if isinstance(behavior, int):
+            self.send_response(behavior)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        offset = 0
+        range_header = self.headers.get('Range')
+        if range_header is not None:
+            offset = int(range_header.replace('bytes=', '').rstrip('-'))
+            if offset >= len(content):
+                self.send_response(416)
+                self.send_header('Content-Range', f'bytes */{len(content)}')
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header('Content-Range', f'bytes {offset}-{len(content) - 1}/{len(content)}')
+        else:
+            self.send_response(200)
+        self.send_header('Content-Length', str(len(content) - offset))
+        self.end_headers()
+        if behavior == 'truncate':
+            self.wfile.write(content[offset:offset + (len(content) - offset) // 2])
+            self.close_connection = True
+        else:
+            self.wfile.write(content[offset:])
+
+    def log_message(self, format, *args):
+        pass
+
+@pytest.fixture
+def server(monkeypatch):
+    monkeypatch.setattr(source_download, 'backoff_seconds', 0.0)
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    server.requests = []
+    server.plans = {}
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    server.url = f'http://127.0.0.1:{server.server_address[1]}'
+    yield server
+    server.shutdown()
+    server.server_close()
+
+def read(filepath):
+    with open(filepath, 'rb') as f:
+        return f.read()
+
+def test_resume_after_truncated_body(server, tmp_path):
+    server.plans['/a.tif'] = ['truncate']
+    failed_urls = source_download.download([f'{server.url}/a.tif'], str(tmp_path), num_threads=1)
+    assert failed_urls == []
+    assert read(tmp_path / 'a.tif') == content
+    assert server.requests == [('/a.tif', None), ('/a.tif', f'bytes={len(content) // 2}-')]
+    assert not os.path.isfile(source_download.get_partial_filepath(str(tmp_path / 'a.tif')))
+
+def test_retry_after_server_error(server, tmp_path):
+    server.plans['/b.tif'] = [503, 502]
+    failed_urls = source_download.download([f'{server.url}/b.tif'], str(tmp_path), num_threads=1)
+    assert failed_urls == []
+    assert read(tmp_path / 'b.tif') == content
+    assert len(server.requests) == 3
+
+def test_reconnect_stale_keep_alive_connection(server, tmp_path, monkeypatch):
+    monkeypatch.setattr(source_download, 'max_attempts', 1)
+    server.plans['/i.tif'] = ['drop']
+    urls = [f'{server.url}/h.tif', f'{server.url}/i.tif']
+    assert source_download.download(urls, str(tmp_path), num_threads=1) == []
+    assert read(tmp_path / 'i.tif') == content
+    assert [path for path, _ in server.requests] == ['/h.tif', '/i.tif', '/i.tif']
+
+def test_dropped_fresh_connection_is_a_failed_attempt(server, tmp_path, monkeypatch):
+    monkeypatch.setattr(source_download, 'max_attempts', 1)
+    server.plans['/j.tif'] = ['drop']
+    assert source_download.download([f'{server.url}/j.tif'], str(tmp_path), num_threads=1) == [f'{server.url}/j.tif']
+
+def test_give_up_on_client_error(server, tmp_path):
+    server.plans['/c.tif'] = [404]
+    failed_urls = source_download.download([f'{server.url}/c.tif'], str(tmp_path), num_threads=1)
+    assert failed_urls == [f'{server.url}/c.tif']
+    assert len(server.requests) == 1
+    assert not os.path.isfile(tmp_path / 'c.tif')
+
+def test_manifest_skips_verified_files(server, tmp_path):
+    urls = [f'{server.url}/{name}.tif' for name in 'def']
+    expected_files = {'d.tif': {'size': len(content), 'sha256': hashlib.sha256(content).hexdigest()}}
+    assert source_download.download(urls, str(tmp_path), expected_files) == []
+    assert len(server.requests) == 3
+
+    manifest = source_download.read_manifest(str(tmp_path))
+    assert sorted(manifest) == ['d.tif', 'e.tif', 'f.tif']
+    assert manifest['d.tif'] == expected_files['d.tif']
+
+    assert source_download.download(urls, str(tmp_path), expected_files) == []
+    assert len(server.requests) == 3
+
+    # a file that changed size since it was verified is resumed, the server rejects the range and it starts over
+    with open(tmp_path / 'e.tif', 'ab') as f:
+        f.write(b'x')
+    assert source_download.download(urls, str(tmp_path), expected_files) == []
+    assert server.requests[3:] == [('/e.tif', f'bytes={len(content) + 1}-'), ('/e.tif', None)]
+    assert read(tmp_path / 'e.tif') == content
+
+def test_checksum_mismatch_fails(server, tmp_path):
+    expected_files = {'g.tif': {'sha256': hashlib.sha256(b'other').hexdigest()}}
+    failed_urls = source_download.download([f'{server.url}/g.tif'], str(tmp_path), expected_files)
+    assert failed_urls == [f'{server.url}/g.tif']
+    assert not os.path.isfile(tmp_path / 'g.tif')
+    assert 'g.tif' not in source_download.read_manifest(str(tmp_path))
@@ -0,0 +1,23 @@
+import numpy as np
+import rasterio
+
+import utils
+
+def write_raster(filepath, data):
+    with rasterio.open(filepath, 'w', driver='GTiff', height=data.shape[0], width=data.shape[1], count=1, dtype='float32', tiled=True, blockxsize=512, blockysize=512) as dst:
+        dst.write(data, 1)
+
+def test_nodata_index_and_has_nodata(tmp_path):
+    data = np.zeros((1100, 700), dtype=np.float32)
+    filepath = str(tmp_path / 'layer.tiff')
+    write_raster(filepath, data)
+    assert not utils.has_nodata(filepath)
+    assert not utils.create_nodata_index(filepath).any()
+
+    data[1050, 600] = -9999
+    write_raster(filepath, data)
+    assert utils.has_nodata(filepath)
+    index = utils.create_nodata_index(filepath)
+    assert index.shape == (3, 2)
+    assert index.tolist() == [[False, False], [False, False], [False, True]]
+    assert (utils.read_nodata_index(filepath) == index).all()
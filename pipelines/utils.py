@@ -1,19 +1,47 @@
 import subprocess
 from pathlib import Path
 from glob import glob
+import hashlib
+import json
 import math
 import os
+import resource
 
 import numpy as np
-
+import rasterio
 import mercantile
-import imagecodecs
 from pmtiles.tile import zxy_to_tileid, TileType, Compression
 from pmtiles.writer import Writer
 
 macrotile_z = 12
 macrotile_buffer_3857 = 250
 num_overviews = 6
+nodata_index_block_size = 512
+
+# write every reprojected layer to an uncompressed full resolution tiff. False lets tiling read the warped vrt
+# of single-layer items directly and saves their multi-gigabyte temporary, items with several layers are always
+# written out, see aggregation_reproject.reproject. stays True until the vrt path has run on real data.
+materialize_reprojection = True
+
+# see webp.py. 'fast' for daily incremental runs, 'max' for the published bundles
+webp_effort = 'default'
+webp_backend = 'imagecodecs'
+# threads per process in webp.encode_batch. tiling already runs one process per core,
+# more threads only pay off for callers that leave cores idle.
+webp_threads = 1
+
+# leave tiles without any source data out of the aggregation archives instead of writing them as 0 m.
+# readers then see them as missing, e.g. masked downsampling in downsampling_create.
+omit_empty_tiles = False
+
+# how aggregation_copy stages the source rasters of a batch, see aggregation_copy.stage_file.
+# 'reference' skips staging and lets the vrts point into source-store directly.
+# every other strategy falls back to a plain copy when the filesystem does not support it.
+staging_strategy = 'hardlink'
+staging_copy_threads = 8
+
+# written by every covering run next to the aggregation items, see read_aggregation_manifest
+aggregation_manifest_filename = 'aggregation-manifest.json'
 
 def run_command(command, silent=True):
     if not silent:
@@ -28,6 +56,28 @@ def run_command(command, silent=True):
         print(out)
     return out, err
 
+def get_peak_rss_mib():
+    '''
+    peak resident memory of this process in MiB, ru_maxrss is in kilobytes on linux
+    '''
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss // 1024
+
+def get_available_memory():
+    '''
+    MemAvailable of /proc/meminfo in bytes, the free pages where it is missing
+    '''
+    available_memory = os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    with open('/proc/meminfo') as f:
+        for line in f:
+            if line.startswith('MemAvailable:'):
+                available_memory = int(line.split()[1]) * 1024
+    return available_memory
+
+def get_staged_source_folder(aggregation_id):
+    if staging_strategy == 'reference':
+        return 'source-store'
+    return f'aggregation-store/{aggregation_id}/tmp-sources'
+
 def create_folder(path):
     folder_path = Path(path)
     folder_path.mkdir(parents=True, exist_ok=True)
@@ -51,16 +101,89 @@ def get_aggregation_ids():
     '''
     return list(sorted([path.split('/')[-1] for path in glob(f'aggregation-store/*')]))
 
-def save_terrarium_tile(data, filepath):
-    data += 32768
-    rgb = np.zeros((512, 512, 3), dtype=np.uint8)
-    rgb[..., 0] = data // 256
-    rgb[..., 1] = data % 256
-    rgb[..., 2] = (data - np.floor(data)) * 256
-    with open(filepath, 'wb') as f:
-        f.write(imagecodecs.webp_encode(rgb, lossless=True))
+def get_merged_filepath(tmp_folder, layer_filepaths):
+    '''
+    the raster that gets tiled, layer_filepaths are the reprojected layers from highest to lowest priority
+    '''
+    if len(layer_filepaths) == 1:
+        return layer_filepaths[0]
+    return f'{tmp_folder}/{len(layer_filepaths)}-3857.tiff'
+
+def get_nodata_index_filepath(raster_filepath):
+    return f'{os.path.splitext(raster_filepath)[0]}-nodata.npy'
+
+def get_nodata_index_windows(src):
+    '''
+    yields the index position and window of every nodata_index_block_size block of the raster
+    '''
+    for i, row in enumerate(range(0, src.height, nodata_index_block_size)):
+        for j, col in enumerate(range(0, src.width, nodata_index_block_size)):
+            yield (i, j), rasterio.windows.Window(
+                col_off=col,
+                row_off=row,
+                width=min(nodata_index_block_size, src.width - col),
+                height=min(nodata_index_block_size, src.height - row)
+            )
+
+def create_nodata_index(tiff_filepath):
+    '''
+    flags for every nodata_index_block_size block of the raster whether it contains -9999 pixels, the nodata that
+    merge fills from lower-priority layers. the index is stored next to the tiff and returned.
+    '''
+    with rasterio.env.Env(GDAL_CACHEMAX=64):
+        with rasterio.open(tiff_filepath) as src:
+            index = np.zeros((math.ceil(src.height / nodata_index_block_size), math.ceil(src.width / nodata_index_block_size)), dtype=bool)
+            for position, window in get_nodata_index_windows(src):
+                index[position] = -9999 in src.read(1, window=window)
+    np.save(get_nodata_index_filepath(tiff_filepath), index)
+    return index
+
+def has_nodata(tiff_filepath):
+    '''
+    whether the raster contains -9999 pixels, stops reading at the first block that does. for layers without an index.
+    '''
+    with rasterio.env.Env(GDAL_CACHEMAX=64):
+        with rasterio.open(tiff_filepath) as src:
+            return any(-9999 in src.read(1, window=window) for _, window in get_nodata_index_windows(src))
+
+def read_nodata_index(raster_filepath):
+    '''
+    returns None when there is no index for the raster, e.g. for warped vrts that were not materialized
+    '''
+    filepath = get_nodata_index_filepath(raster_filepath)
+    if not os.path.isfile(filepath):
+        return None
+    return np.load(filepath)
+
+def get_nodata_index_window(index, row_start, row_end, col_start, col_end):
+    '''
+    the part of a nodata index that covers the pixel window [row_start, row_end) x [col_start, col_end)
+    '''
+    return index[
+        row_start // nodata_index_block_size:math.ceil(row_end / nodata_index_block_size),
+        col_start // nodata_index_block_size:math.ceil(col_end / nodata_index_block_size),
+    ]
+
+def get_tiles_from_folder(tmp_folder):
+    '''
+    yields the tiles in tile id order so that the archive is clustered
+    '''
+    tiles = []
+    for filepath in glob(f'{tmp_folder}/*.webp'):
+        filename = filepath.split('/')[-1]
+        z, x, y = [int(a) for a in filename.replace('.webp', '').split('-')]
+        tiles.append((zxy_to_tileid(z=z, x=x, y=y), z, x, y, filepath))
+    for _, z, x, y, filepath in sorted(tiles):
+        with open(filepath, 'rb') as f:
+            yield z, x, y, f.read()
 
 def create_archive(tmp_folder, out_filepath):
+    write_archive(get_tiles_from_folder(tmp_folder), out_filepath)
+
+def write_archive(tiles, out_filepath):
+    '''
+    tiles is an iterable of (z, x, y, tile_bytes). Yielding them in tile id order gives a clustered archive.
+    '''
     with open(out_filepath, 'wb') as f1:
         writer = Writer(f1)
         min_z = math.inf
@@ -69,13 +192,9 @@ def create_archive(tmp_folder, out_filepath):
         min_lat = math.inf
         max_lon = -math.inf
         max_lat = -math.inf
-        for filepath in glob(f'{tmp_folder}/*.webp'):
-            filename = filepath.split('/')[-1]
-            z, x, y = [int(a) for a in filename.replace('.webp', '').split('-')]
-            
+        for z, x, y, tile_bytes in tiles:
             tile_id = zxy_to_tileid(z=z, x=x, y=y)
-            with open(filepath, 'rb') as f2:
-                writer.write_tile(tile_id, f2.read())
+            writer.write_tile(tile_id, tile_bytes)
 
             max_z = max(max_z, z)
             min_z = min(min_z, z)
@@ -117,7 +236,40 @@ def get_aggregation_item_string(aggregation_id, filename):
     with open(filepath) as f:
         return ''.join(f.readlines())
 
+def get_aggregation_item_hash(item_string):
+    return hashlib.sha256(item_string.encode()).hexdigest()
+
+def read_aggregation_manifest(aggregation_id):
+    '''
+    returns {'items': {filename: hash}, 'removed': [filename]} written by aggregation_covering, or None for older aggregations.
+    removed are the items of the previous aggregation that no longer exist.
+    '''
+    filepath = f'aggregation-store/{aggregation_id}/{aggregation_manifest_filename}'
+    if not os.path.isfile(filepath):
+        return None
+    with open(filepath) as f:
+        return json.load(f)
+
+def write_aggregation_manifest(aggregation_id, item_hashes, removed_filenames):
+    with open(f'aggregation-store/{aggregation_id}/{aggregation_manifest_filename}', 'w') as f:
+        json.dump({'items': item_hashes, 'removed': sorted(removed_filenames)}, f, indent=2, sort_keys=True)
+
+def get_removed_aggregation_filenames(current_aggregation_id, last_aggregation_id):
+    current_manifest = read_aggregation_manifest(current_aggregation_id)
+    if current_manifest is not None:
+        return current_manifest['removed']
+    current_filenames = set([filepath.split('/')[-1] for filepath in glob(f'aggregation-store/{current_aggregation_id}/*-aggregation.csv')])
+    last_filenames = set([filepath.split('/')[-1] for filepath in glob(f'aggregation-store/{last_aggregation_id}/*-aggregation.csv')])
+    return sorted(last_filenames - current_filenames)
+
 def get_dirty_aggregation_filenames(current_aggregation_id, last_aggregation_id):
+    current_manifest = read_aggregation_manifest(current_aggregation_id)
+    last_manifest = read_aggregation_manifest(last_aggregation_id)
+    if current_manifest is not None and last_manifest is not None:
+        last_hashes = last_manifest['items']
+        return sorted([filename for filename, item_hash in current_manifest['items'].items() if last_hashes.get(filename) != item_hash])
+
+    # aggregations from before the manifest was introduced
     filepaths = sorted(glob(f'aggregation-store/{current_aggregation_id}/*-aggregation.csv'))
 
     dirty_filenames = []
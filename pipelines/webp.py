@@ -0,0 +1,148 @@
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import io
+import sys
+import time
+
+import numpy as np
+from PIL import Image
+import imagecodecs
+from pmtiles.reader import Reader, MmapSource, all_tiles
+
+import utils
+import terrarium
+
+# lossless level (0-100) and method (0-6) trade encoding time against size.
+# None keeps the libwebp defaults, which is what the archives were encoded with so far.
+efforts = {
+    'fast': {'level': 0, 'method': 0},
+    'default': {'level': None, 'method': None},
+    'max': {'level': 100, 'method': 6},
+}
+
+def encode_imagecodecs(rgb, level, method):
+    return imagecodecs.webp_encode(rgb, level=level, lossless=True, method=method)
+
+def encode_pillow(rgb, level, method):
+    options = {'lossless': True}
+    if level is not None:
+        options['quality'] = level
+    if method is not None:
+        options['method'] = method
+    buffer = io.BytesIO()
+    Image.fromarray(rgb).save(buffer, format='WEBP', **options)
+    return buffer.getvalue()
+
+backends = {
+    'imagecodecs': encode_imagecodecs,
+    'pillow': encode_pillow,
+}
+
+# backends that release the GIL while encoding, only these get threads in encode_batch.
+# both were checked with get_gil_share, python webp.py reports it for the configured backend.
+gil_free_backends = {'imagecodecs', 'pillow'}
+
+# encoded flat tiles by (terrarium rgb, effort, backend), see encode_constant
+constant_tiles = {}
+max_constant_tiles = 4096
+
+def encode(rgb, effort=None, backend=None):
+    effort = utils.webp_effort if effort is None else effort
+    backend = utils.webp_backend if backend is None else backend
+    return backends[backend](rgb, **efforts[effort])
+
+def encode_constant(elevation, effort=None, backend=None):
+    '''
+    the encoded 512x512 tile of a single elevation. flat tiles like sea level are encoded once per process
+    and give the same bytes as encoding the full tile.
+    '''
+    effort = utils.webp_effort if effort is None else effort
+    backend = utils.webp_backend if backend is None else backend
+    rgb = terrarium.encode(np.full((1, 1), elevation, dtype=np.float32))[0, 0]
+    key = (bytes(rgb), effort, backend)
+    if key not in constant_tiles:
+        if len(constant_tiles) == max_constant_tiles:
+            constant_tiles.clear()
+        constant_tiles[key] = encode(np.broadcast_to(rgb, (512, 512, 3)).copy(), effort, backend)
+    return constant_tiles[key]
+
+def encode_batch(rgbs, effort=None, backend=None, num_threads=None):
+    '''
+    encodes a sequence of rgb tiles with a thread pool when the backend releases the GIL, one after another otherwise.
+    returns the encoded bytes in input order.
+    '''
+    num_threads = utils.webp_threads if num_threads is None else num_threads
+    backend = utils.webp_backend if backend is None else backend
+    if num_threads <= 1 or len(rgbs) <= 1 or backend not in gil_free_backends:
+        return [encode(rgb, effort, backend) for rgb in rgbs]
+    with ThreadPoolExecutor(num_threads) as executor:
+        return list(executor.map(lambda rgb: encode(rgb, effort, backend), rgbs))
+
+def get_benchmark_tiles(num_tiles, pmtiles_filepath=None):
+    if pmtiles_filepath is not None:
+        rgbs = []
+        with open(pmtiles_filepath, 'r+b') as f:
+            reader = Reader(MmapSource(f))
+            for _, tile_bytes in all_tiles(reader.get_bytes):
+                rgbs.append(imagecodecs.webp_decode(tile_bytes))
+                if len(rgbs) == num_tiles:
+                    break
+        return rgbs
+    rng = np.random.default_rng(0)
+    y, x = np.mgrid[0:512, 0:512].astype(np.float32)
+    rgbs = []
+    for j in range(num_tiles):
+        data = 1000.0 + 500.0 * np.sin((x + 37 * j) / 83.0) * np.cos((y - 11 * j) / 127.0)
+        data += rng.normal(0.0, 0.5, data.shape).astype(np.float32)
+        rgbs.append(terrarium.encode(data))
+    return rgbs
+
+def get_gil_share(rgb, backend, effort='default'):
+    '''
+    share of the iterations a pure python thread keeps making while rgb is encoded, compared with running alone.
+    ~0 when the backend holds the GIL, ~0.5 on a single core and ~1 with a spare core when it releases it.
+    '''
+    def count(seconds):
+        counter = [0]
+        stop = threading.Event()
+        def spin():
+            while not stop.is_set():
+                counter[0] += 1
+        thread = threading.Thread(target=spin)
+        thread.start()
+        if seconds is None:
+            t1 = time.time()
+            encode(rgb, effort, backend)
+            seconds = time.time() - t1
+        else:
+            time.sleep(seconds)
+        stop.set()
+        thread.join()
+        return counter[0], seconds
+
+    encoding, seconds = count(None)
+    alone, _ = count(seconds)
+    return encoding / max(alone, 1)
+
+def benchmark(pmtiles_filepath=None, num_tiles=2, backend=None):
+    '''
+    size and speed per effort for one backend, both backends wrap libwebp and give the same bytes.
+    'max' takes ~20 s per tile, keep num_tiles small.
+    '''
+    backend = utils.webp_backend if backend is None else backend
+    rgbs = get_benchmark_tiles(num_tiles, pmtiles_filepath)
+    print(f'{len(rgbs)} tiles from {pmtiles_filepath or "synthetic terrain"}')
+    print(f'{backend}: a python thread keeps {get_gil_share(rgbs[0], backend):.0%} of its speed while encoding')
+    for effort in efforts:
+        t1 = time.time()
+        sizes = [len(tile_bytes) for tile_bytes in encode_batch(rgbs, effort, backend, num_threads=1)]
+        t_single = time.time() - t1
+        line = f'{backend} {effort}: {int(sum(sizes) / len(sizes) / 1024)} KiB/tile, {len(rgbs) / t_single:.1f} tiles/s single thread'
+        if utils.webp_threads > 1 and len(rgbs) > 1:
+            t1 = time.time()
+            encode_batch(rgbs, effort, backend, num_threads=utils.webp_threads)
+            line += f', {len(rgbs) / (time.time() - t1):.1f} tiles/s with {utils.webp_threads} threads'
+        print(line)
+
+if __name__ == '__main__':
+    benchmark(sys.argv[1] if len(sys.argv) > 1 else None)